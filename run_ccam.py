@@ -1,49 +1,457 @@
 import os
+import re
 import argparse
 import sys
-import commands
-from netCDF4 import Dataset
+import time
+import shutil
+import glob
+import fnmatch
+import csv
+import gzip
+import tarfile
+import json
+import string
+import hashlib
+import resource
+import fcntl
+import numbers
+import subprocess
+from multiprocessing import Process, Pool, cpu_count
+from distutils.spawn import find_executable
+from netCDF4 import Dataset, num2date, date2num
+from datetime import datetime, timedelta
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None  # nearest points are found by brute force, see interp_weights()
 from calendar import monthrange
+from collections import namedtuple
+from contextlib import contextmanager
+
+job_start = time.time()  # start of this job, see job_time_left()
+pp_worker = None  # background post-processing worker (pipeline=1)
+stage_worker = None  # background prefetch of the next month's inputs (stagedir)
+nc_headers = {}   # NetCDF header cache, see read_nc_header()
+
+# processor counts supported for each gridsize, see valid_nproc()
+nproc_table = {48:  [1, 2, 3, 6, 12, 24, 48, 72, 96, 144, 192, 216],
+               72:  [6, 12, 24, 48, 72, 96, 144, 192, 216, 288, 384],
+               96:  [48, 72, 96, 144, 192, 216, 288, 384, 432, 768, 864],
+               144: [96, 144, 192, 216, 288, 384, 432, 768, 864, 1536, 1728],
+               192: [192, 216, 288, 384, 432, 768, 864, 1536, 1728, 3072, 3456],
+               288: [384, 432, 768, 864, 1536, 1728, 3072, 3456, 6144, 6912],
+               384: [768, 864, 1536, 1728, 3072, 3456, 6144, 6912, 12288, 13824],
+               576: [1536, 1728, 3072, 3456, 6144, 6912, 12288, 13824, 24576, 27648],
+               768: [3072, 3456, 6144, 6912, 12288, 13824, 24576, 27648, 49152, 55296]}
+input_plan = {}   # inputs of each month (YYYYMM), see plan_inputs()
+dir_indexes = {}  # directory contents and file mtimes, see dir_index()
+compiled_templates = {}  # keys required by each template, see compile_template()
+profile = {'stages': [], 'commands': []}  # timings of the current month, see run_stage()
+
+# run parameters by type: the input arguments plus the settings derived from them by the
+# setup stages. They do not change during a run, see freeze_config()
+config_ints = ['nproc','gridsize','mlev','iys','ims','iye','ime','leap','ncountmax','nmonths','ktc',
+               'dmode','nstrength','sib','aero','conv','cloud','bmix','river','mlo','casa','ncout',
+               'nctar','tarcomp','tarthreads','ncsurf','ktc_surf','pipeline','plan','autotune','maxproc',
+               'ppnproc','ctmnproc','stats','rechunk','rechunk_workers','rechunk_mem','deflate','shuffle',
+               'ensnproc','dtout','dt']
+config_reals = ['midlon','midlat','gridres','minlat','maxlat','minlon','maxlon','reqres','wallfrac',
+                'autotune_eff','surfcache_size','inv_schmidt','lat0','lon0','res']
+config_strs = ['name','domain','plevs','surfpp','mpi','resubmit','sbatch','walltime','ppmpi','bcdom',
+               'sstfile','sstinit','cmip','rcp','insdir','hdir','bcdir','sstdir','stdat','vegca','stagedir',
+               'stats_hist','rechunk_shape','weightdir','surfcache','aeroemiss','model','pcc2hist','terread',
+               'igbpveg','ocnbath','casafield','summary','ensemble','topofile']
+config_flags = ['ppnproc_auto','ctmnproc_auto']
+config_types = dict([(key, numbers.Integral) for key in config_ints]+[(key, numbers.Real) for key in config_reals]+
+                    [(key, basestring) for key in config_strs]+[(key, bool) for key in config_flags])
+RunConfig = namedtuple('RunConfig',sorted(config_types))
+
+# input namelist settings expected to change from month to month, see diff_namelist()
+nml_date_keys = ['kdate_s','ntau','nrungcm','ifile','mesonest','vegprev','vegfile','vegnext','vegnext2',
+                 'o3file','ofile','restfile','surfile','sstfile']
+
+# high-frequency surface fields (cc_template_4), see regrid_surface()
+surf_names = ['uas','vas','tscrn','rhscrn','psl','rnd','sno','grpl','d10','u10']
+surf_winds = ['uas','vas','d10']  # relative to the cubic panels; rotated by pcc2hist, see regrid_surface()
+
+# aeroemiss input files, see set_aeros()
+aero_keys = ['so2_anth','so2_ship','so2_biom','bc_anth','bc_ship','bc_biom','oc_anth','oc_ship','oc_biom',
+             'volcano','dmsfile','dustfile']
+
+# globpea log patterns, see parse_model_log()
+re_ktau = re.compile(r'\bktau\s*[=:]?\s*(\d+)',re.IGNORECASE)
+re_rank_time = re.compile(r'\b(?:myid|rank|proc(?:ess)?)\s*[=:]?\s*(\d+)\D+?([0-9]+\.[0-9]*(?:[eE][-+]?\d+)?)\s*$',re.IGNORECASE)
+re_nml_setting = re.compile(r'(\w+)\s*=\s*(\'[^\']*\'|"[^"]*"|[^\s,]+)')
+re_timer = re.compile(r'^\s*([A-Za-z][\w .:/()-]*?)\s*[=:]?\s+([0-9]+\.[0-9]*(?:[eE][-+]?\d+)?)\s*$')
 
 def main(inargs):
     "Run the CCAM model"
 
     global d
     d = vars(inargs)
+
+    if d['summary'] != 'none':
+        profile_summary(d['summary'])
+        return
+
+    if d['ensemble'] != 'none':
+        run_ensemble()
+        return
+
     check_inargs()
     create_directories()
-    check_surface_files()
-    calc_dt_out()
-    read_inv_schmidt()
-    calc_res()
-    set_ktc_surf()
-    calc_dt_mod()
-
-    for mth in xrange(0,d['ncountmax']):
-        get_datetime()
-        prep_iofiles()
-        set_mlev_params()
-        config_initconds()
-        set_nudging()
-        set_downscaling()
-        set_cloud()
-        set_river()
-        set_ocean()
-        set_atmos()
-        set_surfc()
-        set_aeros()
-        create_aeroemiss_file()
-        create_sulffile_file()
-        create_input_file()
-        prepare_ccam_infiles()
-        check_correct_host()
-        check_correct_landuse()
-        run_model()
-        post_process_output()
-        update_yearqm()
+
+    if d['autotune'] == 1:
+        autotune_nproc()
+
+    for stage in [check_surface_files, calc_dt_out, read_inv_schmidt, calc_res,
+                  set_ktc_surf, calc_dt_mod, size_ncountmax]:
+        run_stage(stage)
+
+    config = freeze_config()
+
+    for stage in [reset_state, recover_post_processing, plan_inputs, check_templates]:
+        run_stage(stage,config)
+
+    # queue the next job now, to start when this one ends successfully
+    queued = None
+    if 'SLURM_JOB_ID' in os.environ:
+        queued = submit_next_job(os.environ['SLURM_JOB_ID'])
+
+    try:
+        run_months(config)
+    finally:
+        wait_post_process()
+        wait_staging()
 
     restart_flag()
 
+    # months are left but none were queued (no Slurm, or the month loop stopped early)
+    if queued is None:
+        submit_next_job()
+
+def run_months(config):
+    "Run the CCAM model for ncountmax months"
+
+    model_stages, output_stages, counter_stages = month_loop_stages()
+
+    mth = 0
+    while mth < config.ncountmax:
+        if mth > 0 and not(time_for_month()):
+            print "Not enough walltime left for another month; stopping after "+str(mth)+" months"
+            break
+
+        run_stage(get_datetime,config,config.ncountmax-mth)
+        month = dict2str('{iyr}{imth_2digit}')
+
+        # resume from the last completed stage of an interrupted launch
+        if stage_done('archived'):
+            print "Output of "+month+" is already archived; resuming from the month counter"
+            stages = counter_stages
+        elif stage_done('model'):
+            print "Model run of "+month+" is already complete; resuming from post-processing"
+            stages = output_stages + counter_stages
+        else:
+            stages = model_stages + output_stages + counter_stages
+
+        for stage in stages:
+            run_stage(stage)
+
+        write_profile(month)
+        mth = mth + d['nseg']
+
+def month_loop_stages():
+    "Stages of the month loop: model launch, post-processing and archiving, month counter"
+
+    model_stages = [create_aeroemiss_file, create_sulffile_file,
+                    create_input_file, prepare_ccam_infiles, start_staging,
+                    check_correct_host, check_correct_landuse, run_model]
+    output_stages = [start_post_process]
+    counter_stages = [update_counter, update_yearqm]
+
+    return model_stages, output_stages, counter_stages
+
+def run_ensemble():
+    """Run a table of configurations as concurrent sub-runs within one allocation.
+    Each row of the CSV table overrides input arguments of the base run; members
+    run in their own {hdir}/{name} and are packed onto ensnproc ranks"""
+
+    if d['ensnproc'] <= 0:
+        raise ValueError, "ensnproc (total processors of the allocation) is required for an ensemble"
+
+    if not(os.path.isdir(d['hdir'])):
+        os.makedirs(d['hdir'])
+
+    members = []
+    for row in csv.DictReader(open(d['ensemble'])):
+        member = dict((key, val) for key, val in d.iteritems() if not(key in ['ensemble','ensnproc','resubmit']))
+        member.update(dict((key.strip(), val.strip()) for key, val in row.iteritems() if val and val.strip()))
+
+        if not('hdir' in row and row['hdir']):
+            member['hdir'] = os.path.join(d['hdir'],member['name'])
+
+        member_defaults(member,row)
+        members.append(member)
+
+    if not members:
+        raise ValueError('No ensemble members found in '+d['ensemble'])
+
+    # members continued from an earlier job may already be complete
+    for member in [member for member in members if member_complete(member)]:
+        print "Ensemble member "+member['name']+" is already complete"
+        members.remove(member)
+
+    if not members:
+        return
+
+    share = d['ensnproc'] / len(members)
+    for member in members:
+        if not('nproc' in member and member['nproc']) or int(member['nproc']) == 0:
+            member['nproc'] = choose_nproc(int(member['gridsize']),share)
+        if int(member['nproc']) > d['ensnproc']:
+            raise ValueError('Ensemble member '+member['name']+' needs more than ensnproc='+str(d['ensnproc'])+' ranks')
+
+    # concurrent members must be placed on separate cores by the launcher
+    nprocs = sorted(int(member['nproc']) for member in members)
+    if len(nprocs) > 1 and nprocs[0]+nprocs[1] <= d['ensnproc']:
+        for key in ['mpi','ppmpi']:
+            if not(exclusive_launcher(d[key])):
+                raise ValueError(key+"='"+d[key]+"' would start concurrent ensemble members on the same cores; "
+                                 "use "+key+"='srun --exclusive -n'")
+
+    # queue the next job now, to start when this one ends successfully
+    queued = None
+    if 'SLURM_JOB_ID' in os.environ:
+        nleft = max(member_months_left(member) - int(member['ncountmax']) for member in members)
+        queued = submit_next_job(os.environ['SLURM_JOB_ID'],nleft)
+
+    pending = members[:]
+    running = []
+    failed = []
+
+    while pending or running:
+
+        # pack as many members as fit in the free ranks, in table order
+        nfree = d['ensnproc'] - sum(int(member['nproc']) for member, handle in running)
+        for member in pending[:]:
+            if int(member['nproc']) <= nfree:
+                pending.remove(member)
+                running.append((member,launch_member(member)))
+                nfree = nfree - int(member['nproc'])
+
+        time.sleep(10)
+
+        for member, handle in running[:]:
+            if poll_cmd(handle) is not None:
+                running.remove((member,handle))
+                if wait_cmd(handle,check=False) != 0 and not(member_complete(member)):
+                    failed.append(member['name'])
+                print "Ensemble member "+member['name']+" finished"
+
+    if failed:
+        raise ValueError('Ensemble members failed: '+', '.join(failed))
+
+    if queued is None:
+        submit_next_job(nleft=max(member_months_left(member) for member in members))
+
+def member_defaults(member,row):
+    """Recompute the arguments that run_ccam.sh derives from the base domain (output box
+    and sstinit) for a member that changes the domain, unless the row sets them"""
+
+    def given(key):
+        return key in row and row[key] and row[key].strip()
+
+    if any(given(key) for key in ['midlon','midlat','gridres','gridsize']):
+        half = float(member['gridres'])/112.*int(member['gridsize'])/2.
+        for key, centre, sign in [('minlat','midlat',-1),('maxlat','midlat',1),('minlon','midlon',-1),('maxlon','midlon',1)]:
+            if not(given(key)):
+                member[key] = float(member[centre]) + sign*half
+
+    if any(given(key) for key in ['bcdir','bcdom','iys','ims']) and not(given('sstinit')):
+        member['sstinit'] = os.path.join(member['bcdir'],member['bcdom']+str(member['iys'])+str(member['ims'])+'.nc')
+
+def member_months_left(member):
+    "Number of months an ensemble member has not yet simulated, according to its year.qm"
+
+    fname = os.path.join(member['hdir'],'year.qm')
+    iyr, imth = int(member['iys']), int(member['ims'])
+
+    if os.path.exists(fname):
+        yyyymm = open(fname).read().strip()
+        if yyyymm == 'Complete':
+            return 0
+        iyr, imth = int(yyyymm[0:4]), int(yyyymm[4:6])
+
+    return max(0,(int(member['iye'])-iyr)*12 + int(member['ime'])-imth + 1)
+
+def exclusive_launcher(launcher):
+    "Check that an MPI launcher places concurrent jobs on separate cores (srun --exclusive)"
+
+    args = launcher.split()
+
+    return os.path.basename(args[0]) == 'srun' and '--exclusive' in args
+
+def member_complete(member):
+    "Check whether an ensemble member has reached its end date (year.qm is Complete)"
+
+    fname = os.path.join(member['hdir'],'year.qm')
+
+    return os.path.exists(fname) and open(fname).read().strip() == 'Complete'
+
+def launch_member(member):
+    "Start one ensemble member as a separate run_ccam.py process"
+
+    for key in ['hdir','vegca']:
+        if not(os.path.isdir(member[key])):
+            os.makedirs(member[key])
+
+    args = [sys.executable,os.path.abspath(__file__)]
+    for key in sorted(member):
+        args += ['--'+key,str(member[key])]
+
+    print "Starting ensemble member "+member['name']+" on "+str(member['nproc'])+" processors"
+
+    # member arguments are already final; protect braces from dict2str formatting
+    args = [arg.replace('{','{{').replace('}','}}') for arg in args]
+
+    return launch_cmd(args,stdout=os.path.join(member['hdir'],'run_ccam.log'),stderr=os.path.join(member['hdir'],'run_ccam.err'))
+
+def valid_nproc(gridsize):
+    "Processor counts supported by the cubic grid decomposition (see run_ccam.sh)"
+
+    if not(gridsize in nproc_table):
+        raise ValueError('No supported processor counts listed for gridsize='+str(gridsize)+
+                         '. Listed gridsizes are '+str(sorted(nproc_table)))
+
+    return nproc_table[gridsize]
+
+def choose_nproc(gridsize,maxproc):
+    "Largest supported processor count up to maxproc (or the smallest supported count)"
+
+    nprocs = [nproc for nproc in valid_nproc(gridsize) if nproc <= maxproc]
+
+    if not nprocs:
+        return valid_nproc(gridsize)[0]
+
+    return nprocs[-1]
+
+def check_decomposition(gridsize,nproc):
+    """Check that nproc decomposes the cubic grid: 1, 2 or 3 processors, or 6 faces split
+    into nxp*nyp blocks with nxp <= nyp <= 2*nxp that both divide the face size"""
+
+    if nproc in [1,2,3]:
+        return True
+
+    if nproc % 6 != 0:
+        return False
+
+    npanel = nproc / 6
+    for nxp in xrange(1,int(npanel**0.5)+1):
+        nyp = npanel / nxp
+        if nxp*nyp == npanel and nyp <= 2*nxp and gridsize % nxp == 0 and gridsize % nyp == 0:
+            return True
+
+    return False
+
+def autotune_nproc():
+    """Choose nproc for the model and ppnproc for pcc2hist from the timings of previous
+    months (metrics.jsonl and profiles), and record the choice in {hdir}/run_meta.json"""
+
+    meta = {'requested': {'nproc': d['nproc'], 'ppnproc': d['ppnproc']}, 'maxproc': d['maxproc'],
+            'efficiency': d['autotune_eff'], 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+    # model: wall time per simulated day at each processor count
+    samples = []
+    fname = dict2str('{hdir}/metrics.jsonl')
+    if os.path.exists(fname):
+        for line in open(fname):
+            record = json.loads(line)
+            if record['gridsize'] == d['gridsize'] and record['mlev'] == d['mlev'] and record['simdays'] > 0:
+                samples.append((record['nproc'],record['wall']/record['simdays']))
+
+    # a given ppnproc must divide the model count
+    candidates = [nproc for nproc in valid_nproc(d['gridsize']) if nproc <= d['maxproc']]
+    if not(d['ppnproc_auto']):
+        candidates = [nproc for nproc in candidates if nproc % d['ppnproc'] == 0]
+    d['nproc'], meta['model'] = choose_scaled_nproc(samples,candidates,d['nproc'])
+
+    # pcc2hist: wall time per month of the main conversion (pcc2hist.log) at the number
+    # of ranks it was launched on, on divisors of the model count
+    samples = []
+    for fname in glob.glob(dict2str('{hdir}/profile/profile.*.json')):
+        record = json.load(open(fname))
+        for command in record['commands']:
+            if (command['command'] == os.path.basename(d['pcc2hist']) and command['exit'] == 0
+                and command.get('stdout') == 'pcc2hist.log' and command_nproc(command['args'],command['command'])):
+                samples.append((command_nproc(command['args'],command['command']),command['wall']))
+
+    if d['ppnproc_auto']:
+        candidates = [nproc for nproc in xrange(1,d['nproc']+1) if d['nproc'] % nproc == 0]
+        if d['pipeline'] == 1 and len(candidates) > 1:
+            candidates.remove(d['nproc'])
+        default = max([nproc for nproc in candidates if nproc <= max(1,d['nproc']/4)])
+        d['ppnproc'], meta['pcc2hist'] = choose_scaled_nproc(samples,candidates,default)
+    else:
+        meta['pcc2hist'] = {'reason': 'set by ppnproc', 'samples': len(samples)}
+
+    if d['ctmnproc_auto']:
+        d['ctmnproc'] = default_ctmnproc()
+
+    check_nproc()
+
+    meta['chosen'] = {'nproc': d['nproc'], 'ppnproc': d['ppnproc']}
+    print 'Autotune: nproc='+str(d['nproc'])+' ('+meta['model']['reason']+'), ppnproc='+str(d['ppnproc'])+' ('+meta['pcc2hist']['reason']+')'
+
+    with open(dict2str('{hdir}/run_meta.json'),'w') as ofile:
+        json.dump(meta,ofile,indent=1,sort_keys=True)
+
+def choose_scaled_nproc(samples,candidates,default):
+    """Fit T(p) = a + b/p to (nproc, time) samples and return the largest candidate whose
+    parallel efficiency relative to the smallest measured count is at least autotune_eff.
+    With samples at a single count, the candidate nearest double (or else half) that
+    count is returned, to measure a second point for the fit"""
+
+    nprocs = sorted(set(sample[0] for sample in samples))
+
+    if not nprocs:
+        return default, {'reason': 'no timing history', 'samples': 0}
+
+    if len(nprocs) == 1:
+        larger = [nproc for nproc in candidates if nproc > nprocs[0]]
+        smaller = [nproc for nproc in candidates if nproc < nprocs[0]]
+        if larger:
+            return min(larger,key=lambda nproc: abs(nproc-2*nprocs[0])), {'reason': 'exploring a second count', 'samples': len(samples)}
+        if smaller:
+            return min(smaller,key=lambda nproc: abs(nproc-nprocs[0]/2.)), {'reason': 'exploring a second count', 'samples': len(samples)}
+        return default, {'reason': 'no other candidate to explore', 'samples': len(samples)}
+
+    # least squares fit of time against 1/nproc
+    xs = [1./sample[0] for sample in samples]
+    ys = [sample[1] for sample in samples]
+    xmean = sum(xs)/len(xs)
+    ymean = sum(ys)/len(ys)
+    sxx = sum((x-xmean)**2 for x in xs)
+    b = sum((x-xmean)*(y-ymean) for x, y in zip(xs,ys))/sxx
+    a = ymean - b*xmean
+
+    def predict(nproc):
+        return max(a + b/nproc, 1.e-6)
+
+    pref = nprocs[0]
+    efficient = [nproc for nproc in candidates
+                 if nproc >= pref and predict(pref)*pref/(predict(nproc)*nproc) >= d['autotune_eff']]
+
+    fit = {'serial': a, 'parallel': b, 'samples': len(samples)}
+
+    if not efficient:
+        fit['reason'] = 'no candidate reaches the target efficiency'
+        return default, fit
+
+    fit['reason'] = 'scaling fit'
+    return max(efficient), fit
+
 def check_inargs():
     "Check all inargs are specified and are internally consistent"
 
@@ -55,651 +463,2891 @@ def check_inargs():
                   'sstinit','cmip','insdir','hdir','bcdir','sstdir','stdat',
                   'vegca','aeroemiss','model','pcc2hist','terread','igbpveg','ocnbath','casafield']
 
-    for i in args2check:
-     if not( i in d.keys() ):
-         print 'Missing input argument --'+i
-         sys.exit(1)
+    for i in args2check:
+     if not( i in d.keys() ):
+         print 'Missing input argument --'+i
+         sys.exit(1)
+
+    if d['ncout'] == 3 and d['sib'] != 2:
+        raise ValueError, "sib=2 is required for ctm output"
+        # I could simply hard-wire this here
+
+    if d['ncout'] == 3 and d['nstrength'] != 1:
+        raise ValueError, "nstrength=1 is required for ctm output"
+
+    d['plevs'] = d['plevs'].replace(',',', ')
+
+    if d['maxproc'] == 0:
+        d['maxproc'] = d['nproc']
+
+    # the walltime of a Slurm job is read from the job itself
+    if d['walltime'] == 'none':
+        d['walltime'] = slurm_walltime()
+
+    # autotune only chooses ppnproc and ctmnproc if they were not given
+    d['ppnproc_auto'] = d['ppnproc'] == 0
+    d['ctmnproc_auto'] = d['ctmnproc'] == 0
+
+    if d['ppnproc'] < 0:
+        raise ValueError, "ppnproc must be positive (or 0 to use nproc)"
+
+    if d['ppnproc_auto']:
+        d['ppnproc'] = default_ppnproc()
+
+    if d['ctmnproc_auto']:
+        d['ctmnproc'] = default_ctmnproc()
+
+    check_nproc()
+
+    stats_bins()
+
+    if not(re.match(r'^\d+,\d+,\d+$',d['rechunk_shape'])) or 0 in [int(size) for size in d['rechunk_shape'].split(',')[1:]]:
+        raise ValueError, "rechunk_shape must be time,lat,lon chunk sizes (time 0 = whole month)"
+
+    if d['nmonths'] < 1:
+        raise ValueError, "nmonths must be at least 1"
+
+    if d['nmonths'] > 1 and d['dmode'] != 1:
+        raise ValueError, "nmonths>1 requires dmode=1 (host files are monthly)"
+
+    if d['nmonths'] > 1 and d['aero'] != 0:
+        raise ValueError, "nmonths>1 requires aero=0 (aerosol forcing is generated per month)"
+
+def default_ppnproc():
+    """Default ppnproc: nproc, or with pipeline=1 (pcc2hist beside the model) the largest
+    divisor of nproc up to nproc/4"""
+
+    if d['pipeline'] == 1:
+        return max(nproc for nproc in xrange(1,d['nproc']+1) if d['nproc'] % nproc == 0 and nproc <= max(1,d['nproc']/4))
+
+    return d['nproc']
+
+def default_ctmnproc():
+    """Default ctmnproc: with a launcher that places concurrent jobs on separate cores
+    (srun --exclusive), about four concurrent CTM days on divisors of ppnproc;
+    otherwise one day at a time on all ppnproc ranks"""
+
+    if exclusive_launcher(d['ppmpi']):
+        return max(nproc for nproc in xrange(1,d['ppnproc']+1) if d['ppnproc'] % nproc == 0 and nproc <= max(1,d['ppnproc']/4))
+
+    return d['ppnproc']
+
+def check_nproc():
+    """Check the processor counts of the model, pcc2hist and the CTM jobs against each
+    other and the launchers. Repeated after autotune changes them"""
+
+    if not(check_decomposition(d['gridsize'],d['nproc'])):
+        message = 'nproc='+str(d['nproc'])+' is not a valid decomposition of C'+str(d['gridsize'])
+        if d['gridsize'] in nproc_table:
+            message = message+'. Supported values include '+str(valid_nproc(d['gridsize']))
+        raise ValueError(message)
+
+    # each pcc2hist rank reads a whole number of the model's output files
+    if d['ppnproc'] < 1 or d['ppnproc'] > d['nproc'] or d['nproc'] % d['ppnproc'] != 0:
+        raise ValueError('ppnproc='+str(d['ppnproc'])+' must divide nproc='+str(d['nproc']))
+
+    if d['pipeline'] == 1 and os.path.basename(d['ppmpi'].split()[0]) == 'mpirun':
+        if d['ppnproc'] >= d['nproc']:
+            raise ValueError, "pipeline=1 with mpirun would start pcc2hist on the cores of the running model; use a smaller ppnproc or ppmpi='srun --exclusive -n'"
+        print "WARNING: pipeline=1 with mpirun shares cores between pcc2hist and the model; ppmpi='srun --exclusive -n' runs pcc2hist as a separate job step"
+
+    if d['ctmnproc'] < 0 or d['ctmnproc'] > d['ppnproc']:
+        raise ValueError, "ctmnproc must be between 1 and ppnproc (or 0 to use ppnproc)"
+
+    # concurrent CTM jobs must be placed on separate cores (and nodes) by the launcher
+    if d['ncout'] == 3 and d['ctmnproc'] < d['ppnproc'] and not(exclusive_launcher(d['ppmpi'])):
+        raise ValueError, "concurrent CTM jobs (ctmnproc < ppnproc) need ppmpi='srun --exclusive -n' to run on separate cores"
+
+def check_surface_files():
+    "Ensure surface datasets exist"
+
+    d['domain'] = dict2str('{gridsize}_{midlon}_{midlat}_{gridres}km')
+    d['inv_schmidt'] = float(d['gridres']) * float(d['gridsize']) / (112. * 90.)
+
+    missing = [fname for fname in surface_file_names() if not(os.path.exists(d['vegca']+'/'+fname))]
+
+    if not missing:
+        return
+
+    if d['surfcache'] != 'none' and fetch_surface_cache():
+        return
+
+    run_cable()
+
+    if d['surfcache'] != 'none':
+        store_surface_cache()
+
+def surface_file_names():
+    "Names of the surface datasets required in {vegca} for the current domain"
+
+    fnames = [dict2str(fname+'{domain}') for fname in ['topout','bath','casa']]
+    fnames += [dict2str('veg{domain}.'+mon_2digit(mon)) for mon in xrange(1,13)]
+
+    return fnames
+
+def surface_cache_key():
+    """Hash of everything the generated surface datasets depend on: the unrendered
+    preprocessing namelists, the settings they use and the names and sizes of the input
+    datasets in {insdir}/vegin. Where insdir is located does not change the key"""
+
+    sha = hashlib.sha1()
+    keys = set(['gridsize','midlon','midlat','gridres'])
+
+    for template in [top_template(),igbpveg_template(),ocnbath_template(),
+                     'casafield -i {insdir}/vegin/casaNP_gridinfo_1dx1d.nc']:
+        sha.update(template)
+        keys |= compile_template(template)
+
+    for key in sorted(keys - set(['insdir'])):
+        sha.update(key+'='+str(d[key])+'\n')
+
+    vegin = dict2str('{insdir}/vegin')
+    if os.path.isdir(vegin):
+        for fname in sorted(os.listdir(vegin)):
+            sha.update(fname+' '+str(os.path.getsize(os.path.join(vegin,fname)))+'\n')
+
+    return sha.hexdigest()
+
+def fetch_surface_cache():
+    "Copy surface datasets from the shared cache into {vegca}. Returns False on a cache miss"
+
+    key = surface_cache_key()
+    entry = os.path.join(d['surfcache'],key)
+    manifest = os.path.join(entry,'manifest.json')
+
+    try:
+        lock = open(manifest)
+    except IOError:
+        print "Surface cache miss: "+key
+        return False
+
+    with lock:
+        # a shared lock on the manifest keeps evict_surface_cache() from removing the entry
+        # while it is copied; an entry evicted before the lock was taken is a miss
+        fcntl.flock(lock,fcntl.LOCK_SH)
+
+        if not(os.path.exists(manifest)) or os.stat(manifest).st_ino != os.fstat(lock.fileno()).st_ino:
+            print "Surface cache miss (entry evicted): "+key
+            return False
+
+        files = json.load(lock)['files']
+
+        for fname in surface_file_names():
+            if not(fname in files) or os.path.getsize(os.path.join(entry,fname)) != files[fname]:
+                print "Surface cache entry is incomplete, regenerating: "+key
+                return False
+
+        print "Surface cache hit: "+key
+
+        for fname in surface_file_names():
+            tmpname = d['vegca']+'/.'+fname+'.tmp'
+            shutil.copyfile(os.path.join(entry,fname),tmpname)
+            os.rename(tmpname,d['vegca']+'/'+fname)
+
+        # manifest mtime records the last use for LRU eviction
+        os.utime(manifest,None)
+
+    return True
+
+def store_surface_cache():
+    "Publish the surface datasets in {vegca} to the shared cache"
+
+    key = surface_cache_key()
+    entry = os.path.join(d['surfcache'],key)
+
+    if os.path.exists(os.path.join(entry,'manifest.json')):
+        return
+
+    if not(os.path.isdir(d['surfcache'])):
+        os.makedirs(d['surfcache'])
+
+    # build the entry under a private name and rename it into place
+    tmpentry = os.path.join(d['surfcache'],'.tmp.'+key+'.'+str(os.getpid()))
+    os.mkdir(tmpentry)
+
+    files = {}
+    for fname in surface_file_names():
+        shutil.copyfile(d['vegca']+'/'+fname,os.path.join(tmpentry,fname))
+        files[fname] = os.path.getsize(os.path.join(tmpentry,fname))
+
+    manifest = {'key': key, 'domain': d['domain'], 'files': files,
+                'inputs': dict((name, d[name]) for name in ['gridsize','midlon','midlat','gridres','inv_schmidt','insdir']),
+                'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'user': os.environ.get('USER','')}
+
+    with open(os.path.join(tmpentry,'manifest.json'),'w') as ofile:
+        json.dump(manifest,ofile,indent=1,sort_keys=True)
+
+    try:
+        os.rename(tmpentry,entry)
+        print "Surface datasets added to cache: "+key
+    except OSError:
+        # another run published the same entry first
+        shutil.rmtree(tmpentry)
+
+    evict_surface_cache(keep=key)
+
+def evict_surface_cache(keep=None):
+    "Remove least recently used cache entries until the cache fits in surfcache_size (GB)"
+
+    entries = []
+    for key in os.listdir(d['surfcache']):
+        manifest = os.path.join(d['surfcache'],key,'manifest.json')
+        if os.path.exists(manifest):
+            size = sum(json.load(open(manifest))['files'].values())
+            entries.append((os.path.getmtime(manifest),key,size))
+
+    total = sum(entry[2] for entry in entries)
+    maxsize = d['surfcache_size']*1024**3
+
+    for lastused, key, size in sorted(entries):
+        if total <= maxsize:
+            break
+        if key == keep:
+            continue
+
+        try:
+            lock = open(os.path.join(d['surfcache'],key,'manifest.json'))
+        except IOError:
+            continue
+
+        # entries being copied (shared lock, see fetch_surface_cache()) are skipped; the
+        # entry is renamed away under the lock, so a later reader finds it missing
+        trash = os.path.join(d['surfcache'],'.del.'+key+'.'+str(os.getpid()))
+        with lock:
+            try:
+                fcntl.flock(lock,fcntl.LOCK_EX|fcntl.LOCK_NB)
+                os.rename(os.path.join(d['surfcache'],key),trash)
+            except (IOError, OSError):
+                continue
+
+        shutil.rmtree(trash)
+        total -= size
+        print "Surface cache entry evicted: "+key
+
+def run_cable():
+    """Generate topography and land-use files for CCAM.
+    The preprocessing tools run as a task graph in surfgen.{domain}; completed
+    tasks are kept there, so a failed generation restarts from the failed task"""
+
+    graphdir = dict2str('surfgen.{domain}')
+    run_task_graph(surface_tasks(),graphdir)
+
+    for fname in surface_file_names():
+        tmpname = d['vegca']+'/.'+fname+'.tmp'
+        shutil.move(os.path.join(graphdir,fname),tmpname)
+        os.rename(tmpname,d['vegca']+'/'+fname)
+
+    shutil.rmtree(graphdir)
+
+def surface_tasks():
+    """Task graph for generating the surface datasets.
+    inputs and outputs map file names in the task's scratch directory to file
+    names in the graph directory; a task runs once all of its inputs exist"""
+
+    vegfiles = [dict2str('veg{domain}.'+mon_2digit(mon)) for mon in xrange(1,13)]
+
+    return [
+        {'name': 'terread', 'desc': 'Generating topography file',
+         'nml': ('top.nml',top_template()), 'args': ['{terread}'],
+         'inputs': {}, 'links': [],
+         'outputs': {dict2str('topout{domain}'): dict2str('topterr{domain}')}},
+
+        {'name': 'igbpveg', 'desc': 'Generating MODIS land-use data',
+         'nml': ('igbpveg.nml',igbpveg_template()), 'args': ['{igbpveg}','-s','1000'],
+         'inputs': {dict2str('topout{domain}'): dict2str('topterr{domain}')}, 'links': [],
+         'outputs': dict([(dict2str('topsib{domain}'), dict2str('topout{domain}'))]+
+                         [(fname, fname) for fname in vegfiles])},
+
+        {'name': 'ocnbath', 'desc': 'Processing bathymetry data',
+         'nml': ('ocnbath.nml',ocnbath_template()), 'args': ['{ocnbath}','-s','1000'],
+         'inputs': {dict2str('topout{domain}'): dict2str('topout{domain}')}, 'links': ['{insdir}/vegin/*.bil'],
+         'outputs': {dict2str('bath{domain}'): dict2str('bath{domain}')}},
+
+        {'name': 'casafield', 'desc': 'Processing CASA data',
+         'nml': None, 'args': ['{casafield}','-t','topout{domain}','-i','{insdir}/vegin/casaNP_gridinfo_1dx1d.nc','-o','casa{domain}'],
+         'inputs': {dict2str('topout{domain}'): dict2str('topout{domain}')}, 'links': [],
+         'outputs': {dict2str('casa{domain}'): dict2str('casa{domain}')}}]
+
+def run_task_graph(tasks,graphdir):
+    """Run a task graph, launching every task whose inputs are ready concurrently.
+    Each task runs in its own scratch directory and its outputs are renamed into
+    graphdir when it succeeds"""
+
+    if not(os.path.isdir(graphdir)):
+        os.mkdir(graphdir)
+
+    def ready(fnames):
+        return all(os.path.exists(os.path.join(graphdir,fname)) for fname in fnames)
+
+    pending = [task for task in tasks if not ready(task['outputs'].values())]
+    running = []
+    failed = []
+
+    for task in tasks:
+        if not(task in pending):
+            print "Reusing output of "+task['name']+" from "+graphdir
+
+    while pending or running:
+
+        for task in pending[:]:
+            if ready(task['inputs'].values()):
+                pending.remove(task)
+                running.append((task,launch_task(task,graphdir)))
+
+        if not running:
+            break
+
+        time.sleep(1)
+
+        for task, handle in running[:]:
+            if poll_cmd(handle) is None:
+                continue
+
+            running.remove((task,handle))
+            scratch = os.path.join(graphdir,task['name'])
+
+            if wait_cmd(handle,check=False) != 0 or not all(os.path.exists(os.path.join(scratch,fname)) for fname in task['outputs']):
+                failed.append(task['name'])
+                continue
+
+            for fname, gname in task['outputs'].iteritems():
+                os.rename(os.path.join(scratch,fname),os.path.join(graphdir,gname))
+            shutil.rmtree(scratch)
+
+    if failed or pending:
+        raise ValueError('Surface data generation failed for: '+', '.join(failed+[task['name'] for task in pending])+
+                         ' (see the logs in '+graphdir+')')
+
+def launch_task(task,graphdir):
+    "Prepare a scratch directory for a task and start it"
+
+    print task['desc']
+
+    scratch = os.path.join(graphdir,task['name'])
+
+    if os.path.isdir(scratch):
+        shutil.rmtree(scratch)
+    os.mkdir(scratch)
+
+    for fname, gname in task['inputs'].iteritems():
+        os.symlink(os.path.abspath(os.path.join(graphdir,gname)),os.path.join(scratch,fname))
+
+    for pattern in task['links']:
+        link_files(pattern,scratch)
+
+    stdin = None
+    if task['nml'] is not None:
+        stdin = task['nml'][0]
+        write2file(os.path.join(scratch,stdin),task['nml'][1],mode='w+')
+
+    return launch_cmd(task['args'],stdin=stdin,stdout=task['name']+'.log',cwd=scratch)
+
+def create_directories():
+    "Create output directories and go to working directory"
+
+    os.chdir(dict2str('{hdir}'))
+    
+    for dirname in ['daily','OUTPUT','RESTART','vegdata','wdir']:
+        if not(os.path.isdir(dirname)):
+            os.mkdir(dirname)
+   
+    remove_files('{hdir}/restart.qm')
+
+    os.chdir('wdir')
+
+def calc_dt_out():
+    "Calculate model output timestep"
+
+    d['dtout']=360  # raw cc output frequency (mins)
+
+    if d['ncout'] == 3:
+        d['dtout'] = 60 # need hourly output for CTM
+
+    if d['ktc'] < d['dtout']:
+        d['dtout'] = d['ktc']
+
+def read_inv_schmidt():
+    "Read inverse schmidt value from NetCDF topo file and calculate grid resolution"
+
+    topofile = dict2str('{vegca}/topout{domain}')
+    check_file_exists(topofile)
+    d['topofile'] = topofile
+
+    header = read_nc_header(topofile)
+    d['inv_schmidt'] = header['attrs']['schmidt']
+    d['lon0'] = header['attrs']['lon0']
+    d['lat0'] = header['attrs']['lat0']
+    d['gridsize'] = header['dims']['longitude']
+
+def calc_res():
+    "Calculate resolution for high resolution area"
+
+    gridres_m = d['gridres']*1000. # GRIDRES IN UNITS OF METERS
+
+    res=d['reqres']
+    if res == -1.:
+        res = gridres_m/112000.
+
+    d['gridres'] = gridres_m
+    d['res'] = res
+
+    # CHECK
+    # 1. Should reqres be an input argument - how does this then relate to the pre-defind inv_schmidt?
+    # 2. Note above I have divided by 112000. The original code had 100000.
+
+def set_ktc_surf():
+    "Set tstep for high-frequency output"
+
+    if d['ncsurf'] == 0. :
+        d['ktc_surf'] = d['dtout']
+
+def calc_dt_mod():
+    """Calculate model timestep.
+     dt is a function of dx; dt out and ktc_surf must be integer multiples of dt"""
+
+    # define dictionary of pre-defined dx (mtrs) : dt (sec) relationships
+    d_dxdt = {60000:1200, 45000:900, 36000:720,
+              30000:600, 18000:360, 15000:300,
+              12000:240, 9000:180, 6000:120, 4500:90,
+              4000:80, 3000:60, 2000:40, 1000:20,
+              500:10, 200:4, 100:2, 50:1}
+
+    # determine dt based on dx, dtout and ktc_surf
+    for dx in sorted(d_dxdt):
+        if ( d['gridres'] >= dx ) and ( 60 * d['dtout'] % d_dxdt[dx] == 0 ) and ( 60 * d['ktc_surf'] % d_dxdt[dx] == 0):
+            d['dt'] = d_dxdt[dx]
+
+    if d['gridres'] < 50:
+        raise ValueError, "Minimum grid resolution of 50m has been exceeded"
+
+    #if ( d['dtout'] % dt != 0 ):
+    #    raise ValueError, "dtout must be a multiple of dt" # CHECK: Original code has dtout must be a multiple of dt/60
+    #Is this not redundant code given that dt will be 1, above.
+
+    if ( d['ktc'] % d['dtout'] != 0):
+        raise ValueError, "ktc must be a multiple of dtout"
+
+    if d['ncsurf'] != 0:
+        if ( d['dtout'] % d['ktc_surf'] != 0): # This order is different to original code
+            raise ValueError, "dtout must be a multiple of ktc_surf"
+
+def get_datetime(config,nmonths_left):
+    """Determine relevant dates and timesteps for running model, and make the context of
+    the month, with its inputs checked, the current d"""
+
+    global d
+
+    # Load year.qm with current simulation year:
+    iyr, imth = start_date()
+    if (os.path.exists(dict2str('{hdir}/year.qm'))):
+        print("ATTENTION:")
+        print(dict2str("Simulation start date taken from {hdir}/year.qm"))
+        print("Start date: "+str(iyr)+mon_2digit(imth)+'01')
+        print("If this is the incorrect start date, please delete year.qm")
+
+    # Abort run at finish year:
+    if iyr*100+imth > config.iye*100+config.ime:
+        write2file(config.hdir+'/year.qm',"Complete",mode='w+')
+        raise ValueError, 'CCAM simulation completed normally'
+
+    d = month_context(config,iyr,imth,nmonths_left)
+    resolve_inputs(d)
+
+def start_date():
+    "Year and month of the next launch: from {hdir}/year.qm if present, else iys/ims"
+
+    fname = os.path.join(d['hdir'],'year.qm')
+
+    if os.path.exists(fname):
+        yyyymm = open(fname).read()
+        if yyyymm.strip() == 'Complete':
+            raise ValueError, 'CCAM simulation completed normally'
+        return int(yyyymm[0:4]), int(yyyymm[4:6])
+
+    return d['iys'], d['ims']
+
+def freeze_config():
+    """Check the run parameters in d, complete after the setup stages, against the fields
+    and types of RunConfig and return them as the immutable run configuration"""
+
+    missing = sorted(set(RunConfig._fields) - set(d))
+    unknown = sorted(set(d) - set(RunConfig._fields))
+
+    if missing or unknown:
+        raise ValueError('Run parameters do not match RunConfig: missing '+(', '.join(missing) or 'none')+
+                         '; unexpected '+(', '.join(unknown) or 'none'))
+
+    wrong = [key+'='+repr(d[key]) for key in RunConfig._fields if not(isinstance(d[key],config_types[key]))]
+
+    if wrong:
+        raise ValueError('Run parameters of the wrong type: '+', '.join(wrong))
+
+    return RunConfig(**d)
+
+def month_context(config,iyr,imth,nmonths_left):
+    """Configuration of the launch starting at iyr/imth: the run configuration plus
+    everything derived from the date. Depends only on its arguments; the input files
+    are checked separately, see resolve_inputs()"""
+
+    context = dict(config._asdict())
+    context.update({'iyr': iyr, 'imth': imth, 'nmonths_left': nmonths_left})
+
+    set_month_dates(context)
+    for stage in month_config_stages():
+        stage(context)
+
+    return context
+
+@contextmanager
+def bound(context):
+    "Make a month context the current d for the functions that read it"
+
+    global d
+
+    saved = d
+    d = context
+    try:
+        yield context
+    finally:
+        d = saved
+
+def set_month_dates(context):
+    "Derive the dates, segment and timesteps of the launch starting at context['iyr']/context['imth']"
+
+    edate = context['iye']*100 +context['ime']
+
+    iyr = context['iyr']
+    imth = context['imth']
+
+    # Decade start and end:
+    context['ddyear'] = iyr/10*10
+    context['deyear'] = context['ddyear'] + 9
+
+    # Calculate previous month:
+    if imth == 1:
+        context['imthlst'] = '12'
+        context['iyrlst']  = iyr-1
+    else:
+        context['imthlst'] = imth-1
+        context['iyrlst']  = iyr
+
+    # Calculate the next month:
+    if imth == 12:
+        context['imthnxt'] = 1
+        context['iyrnxt'] = iyr+1
+    else:
+        context['imthnxt'] = imth+1
+        context['iyrnxt'] = iyr
+
+    # Calculate the next next month (+2):
+    if imth > 10:
+        context['imthnxtb'] = imth-10
+    else:
+        context['imthnxtb'] = imth+2
+
+    context['imthlst_2digit'] = mon_2digit(context['imthlst'])
+    context['imth_2digit'] = mon_2digit(context['imth'])
+    context['imthnxt_2digit'] = mon_2digit(context['imthnxt'])
+    context['imthnxtb_2digit'] = mon_2digit(context['imthnxtb'])
+
+    # Calculate number of days in current month:
+    context['ndays'] = month_days(iyr,imth)
+
+    # Months integrated by this model launch (up to nmonths, not crossing the end of the year or run):
+    context['seg_months'] = []
+    offset = 0
+    mth = imth
+
+    while len(context['seg_months']) < min(context['nmonths'],context['nmonths_left']) and mth <= 12 and iyr*100+mth <= edate:
+        context['seg_months'].append({'iyr': iyr, 'imth': mth, 'ndays': month_days(iyr,mth), 'offset': offset})
+        offset = offset + month_days(iyr,mth)
+        mth = mth + 1
+
+    context['nseg'] = len(context['seg_months'])
+    context['imthend_2digit'] = mon_2digit(context['seg_months'][-1]['imth'])
+
+    # Number of steps between output:
+    context['nwt'] = context['dtout']*60/context['dt']
+
+    # Number of steps in run:
+    context['ntau'] = offset*86400/context['dt']
+
+    # Start date string:
+    context['kdates']=str(context['iyr']*10000 + context['imth']*100 + 01)
+
+def prep_iofiles(context):
+    "Prepare input and output files"
+
+    # Define restart file:
+    context['ifile'] = dict2str('Rest{name}.{iyrlst}{imthlst_2digit}',context)
+    context['ofile'] = dict2str('{name}.{iyr}{imth_2digit}',context)
+
+    # Define host model fields:
+    context['mesonest'] = mesonest_name(context,context['iyr'],context['imth'])
+
+    # Define restart file (written at the end of the last month of the launch):
+    context['restfile'] = dict2str('Rest{name}.{iyr}{imthend_2digit}',context)
+
+    # Define ozone infile:
+    context['ozone'] = ozone_name(context,context['iyr'])
+
+    # Define CO2 infile:
+    context['co2file']= dict2str('{stdat}/{cmip}/{rcp}_MIDYR_CONC.DAT',context)
+
+    # Define SST infile:
+    context['sstpath'] = dict2str('{sstdir}/{sstfile}',context)
+
+def plan_inputs(config):
+    """Resolve the inputs of every remaining month before the first model launch and
+    write them to {hdir}/manifest.json. Stops the run if any input is missing"""
+
+    if config.plan == 0:
+        return
+
+    iyr, imth = start_date()
+    missing = []
+    aerofiles = {}
+    input_plan.clear()
+
+    while iyr*100+imth <= config.iye*100+config.ime:
+        context = month_context(config,iyr,imth,1)
+        month = {'ozone': context['ozone'], 'co2file': context['co2file']}
+        required = [month['ozone'],month['co2file']]
+
+        if config.dmode in [0,2]:
+            month['host'] = host_file(context)
+            if month['host'] is None:
+                missing.append(os.path.join(config.bcdir,context['mesonest']))
+
+        if config.dmode == 1:
+            month['sstpath'] = context['sstpath']
+            required.append(month['sstpath'])
+
+        if config.aero == 1:
+            decade = (iyr/10, iyr >= 2010)
+            if decade not in aerofiles:
+                aerofiles[decade] = resolve_aero_files(context,iyr)
+            month['aero'] = aerofiles[decade]
+            required += [month['aero'][key] for key in aero_keys]
+
+        missing += [fpath for fpath in required if not(listed_file_exists(fpath))]
+        input_plan[str(iyr)+mon_2digit(imth)] = month
+
+        imth = imth + 1
+        if imth > 12:
+            iyr, imth = iyr+1, 1
+
+    required = [config.vegca+'/'+fname for fname in surface_file_names()]
+    if config.dmode == 1:
+        required.append(config.sstinit)
+    missing += [fpath for fpath in required if not(listed_file_exists(fpath))]
+
+    if missing:
+        input_plan.clear()
+        missing = sorted(set(missing))
+        raise ValueError(str(len(missing))+' input files are missing for this run:\n  '+'\n  '.join(missing))
+
+    with open(os.path.join(config.hdir,'manifest.json'),'w') as ofile:
+        json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'months': input_plan},ofile,indent=1,sort_keys=True)
+
+    print "Input manifest: "+str(len(input_plan))+" months checked"
+
+def planned_inputs(context):
+    "Inputs of the month of a context resolved by plan_inputs(), or None"
+
+    return input_plan.get(dict2str('{iyr}{imth_2digit}',context))
+
+def resolve_inputs(context):
+    """Check the inputs of the month of a context (unless plan_inputs() already has), find
+    its aerosol emission files and use prefetched copies of slow inputs where available"""
+
+    planned = planned_inputs(context)
+
+    if not planned:
+        for fname in [context['ozone'],context['co2file']]:
+            check_file_exists(fname)
+
+    if context['aero'] == 1:
+        if planned:
+            aero = planned['aero']
+        else:
+            aero = resolve_aero_files(context,context['iyr'])
+            for fpath in aero_keys:
+                check_file_exists(aero[fpath])
+
+        context.update(aero)
+
+    context['ozone'] = staged_copy(context['ozone'])
+    if context['dmode'] == 1:
+        context['sstpath'] = staged_copy(context['sstpath'])
+
+def host_file(context):
+    "Path of the host model file (or first file, or tar archive) for the month of a context, or None"
+
+    fpath = os.path.join(context['bcdir'],context['mesonest'])
+
+    if context['bcdom'] == "ccam_eraint_":
+        candidates = [fpath]
+    else:
+        candidates = [fpath+'.000000',fpath+'.tar',fpath+'.tar.gz']
+
+    for fname in candidates:
+        if listed_file_exists(fname):
+            return fname
+
+    return None
+
+def listed_file_exists(fpath):
+    "Check that a file exists using the directory index instead of a stat per file"
+
+    return os.path.basename(fpath) in dir_index(os.path.dirname(os.path.abspath(fpath)))
+
+def mesonest_name(params,iyr,imth):
+    "Name of the host model file for a month"
+
+    if params['bcdom'] == 'ccam_eraint_':
+        return params['bcdom']+str(iyr)+mon_2digit(imth)+'.nc'
+
+    return params['bcdom']+'.'+str(iyr)+mon_2digit(imth)
+
+def ozone_name(params,iyr):
+    "Path of the ozone file for the decade containing iyr"
+
+    decade = dict(params, ddyear=iyr/10*10, deyear=iyr/10*10+9)
+
+    if params['rcp'] == "historic" or iyr < 2005 :
+        return '{stdat}/{cmip}/historic/pp.Ozone_CMIP5_ACC_SPARC_{ddyear}-{deyear}_historic_T3M_O3.nc'.format(**decade)
+
+    return '{stdat}/{cmip}/{rcp}/pp.Ozone_CMIP5_ACC_SPARC_{ddyear}-{deyear}_{rcp}_T3M_O3.nc'.format(**decade)
+
+def set_mlev_params(context):
+    "Set the parameters related to the number of model levels"
+
+    d_mlev_eigenv = {27:"eigenv27-10.300", 35:"eigenv.35b", 54:"eigenv.54b", 72:"eigenv.72b", 108:"eigenv.108b", 144:"eigenv.144b"}
+    d_mlev_modlolvl = {27:20, 35:30, 54:40, 72:60, 108:80, 144:100}
+
+    context.update({'nmr': 1, 'acon': 0.00, 'bcon': 0.04, 'eigenv': d_mlev_eigenv[context['mlev']], 'mlolvl': d_mlev_modlolvl[context['mlev']]})
+
+def config_initconds(context):
+    "Configure initial condition file"
+
+    context['nrungcm'] = 0
+
+    if context['iyr'] == context['iys'] and context['imth'] == context['ims']:
+
+        context['nrungcm'] = -1
+
+        if context['dmode'] in [0,2]:
+            context.update({'ifile': context['mesonest']})
+        else:
+            context.update({'ifile': context['sstinit']})
+
+def set_nudging(context):
+    "Set nudging strength parameters"
+
+    if context['nstrength'] == 0:
+        context.update({'mbd_base': 20, 'mbd_maxgrid': 999999, 'mbd_maxscale': 3000,
+                'kbotdav': -900, 'sigramplow': 0.05})
+
+    elif context['nstrength'] == 1:
+        context.update({'mbd_base': 20, 'mbd_maxgrid': 24, 'mbd_maxscale': 500,
+                'kbotdav': 1, 'sigramplow': 0.00})
+
+def set_downscaling(context):
+    "Set downscaling parameters"
+
+    if context['dmode'] == 0:
+        context.update({'dmode_meth': 0, 'nud_p': 1, 'nud_q': 0, 'nud_t': 1,
+                'nud_uv': 1, 'mfix': 0, 'mfix_qg': 1, 'mfix_aero': 1,
+                'nbd': 0, 'mbd': context['mbd_base'], 'namip': 0, 'nud_aero': 0})
+
+    elif context['dmode'] == 1:
+        context.update({'dmode_meth': 1, 'nud_p': 0, 'nud_q': 0, 'nud_t': 0,
+                'nud_uv': 0, 'mfix': 1, 'mfix_qg': 1, 'mfix_aero': 1,
+                'nbd': 0, 'mbd': 0, 'namip': 14, 'nud_aero': 0})
+
+    elif context['dmode'] == 2:
+        context.update({'dmode_meth': 0, 'nud_p': 1, 'nud_q': 1, 'nud_t': 1,
+                'nud_uv': 1, 'mfix': 0, 'mfix_qg': 0, 'mfix_aero': 0,
+                'nbd': 0, 'mbd': context['mbd_base'], 'namip': 0, 'nud_aero': 1})
+
+def set_cloud(context):
+    "Cloud microphysics settings"
+
+    if context['cloud'] == 0:
+        context.update({'ncloud': 0})
+
+    elif context['cloud'] == 1:
+        context.update({'ncloud': 2})
+
+    elif context['cloud'] == 2:
+        context.update({'ncloud': 3})
+
+def set_river(context):
+    "River physics settings"
+
+    if context['river'] == 0:
+        context.update({'nriver': 0})
+
+    elif context['river'] == 1:
+        context.update({'nriver': -1})
+
+def set_ocean(context):
+    "Ocean physics settings"
+
+    if context['mlo'] == 0:
+        #Interpolated SSTs
+        context.update({'nmlo': 0, 'mbd_mlo': 0, 'nud_sst': 0,
+                'nud_sss': 0, 'nud_ouv': 0, 'nud_sfh': 0,
+                'kbotmlo': -1000})
+
+    else:
+        #Dynanical Ocean
+        if context['river'] != 1:
+            raise ValueError, 'river=1 is a requirement for ocean mlo=1'
+
+        if context['dmode'] == 0 or context['dmode'] == 1:
+            # Downscaling mode - GCM or SST-only:
+            context.update({'nmlo': -3, 'mbd_mlo': 20, 'nud_sst': 1,
+                    'nud_sss': 0, 'nud_ouv': 0, 'nud_sfh': 0,
+                    'kbotmlo': -100})
+
+        elif context['dmode'] == 2:
+            # Downscaling CCAM:
+            context.update({'nmlo': -3, 'mbd_mlo': 20, 'nud_sst': 1,
+                    'nud_sss': 1, 'nud_ouv': 1, 'nud_sfh': 1,
+                    'kbotmlo': -1000})
+
+def set_atmos(context):
+    "Atmospheric physics settings"
+    if context['sib'] == 1:
+        context.update({'nsib': 7})
+
+        if context['casa'] == 0:
+            context.update({'ccycle': 0, 'proglai': -1})
+
+        elif context['casa'] == 1:
+            context.update({'ccycle': 3, 'proglai': 1})
+
+    elif context['sib'] == 2:
+        context.update({'nsib': 5, 'ccycle': 0, 'proglai': -1})
+
+        if context['casa'] == 1:
+            raise ValueError, "casa=1 requires sib=1"
+
+    context.update({ 'vegin': context['vegca'],
+        'vegprev': dict2str('veg{domain}.{imthlst_2digit}',context),
+        'vegfile': dict2str('veg{domain}.{imth_2digit}',context),
+        'vegnext': dict2str('veg{domain}.{imthnxt_2digit}',context),
+        'vegnextb': dict2str('veg{domain}.{imthnxtb_2digit}',context) })
+
+    if context['bmix'] == 0:
+        context.update({'nvmix': 3, 'nlocal': 6})
+
+    elif context['bmix'] == 1:
+        context.update({'nvmix': 6, 'nlocal': 7})
+
+    context.update({'ngwd': -5, 'helim': 800., 'fc2': 1., 'sigbot_gwd': 0., 'alphaj': '0.000001'})
+
+    if context['conv'] == 2:
+        context.update({'ngwd': -20, 'helim': 1600.,'fc2': -0.5, 'sigbot_gwd': 1., 'alphaj': '0.025'})
+
+def set_surfc(context):
+    "Prepare surface files"
+
+    context.update({'tbave': 0, 'tblock': 0})
+
+    if context['ncsurf'] in [1,2]:
+        context.update({'tbave': context['ktc_surf'] * 60 / context['dt'],
+                  'tblock': context['dtout'] / context['ktc_surf'] })
+
+def set_aeros(context):
+    "Aerosol settings; the emission files are found by resolve_inputs()"
+
+    if context['aero'] == 0:
+        # Aerosols turned off
+        context.update({'iaero': 0, 'sulffile' : 'none'})
+
+    if context['aero'] == 1:
+        # Prognostic aerosols
+        context.update({'iaero': -2, 'sulffile': 'aero.nc'})
+
+def resolve_aero_files(params,iyr):
+    "Paths of the aeroemiss input files for the decade containing iyr"
+
+    ddyear = str(iyr/10*10)
+
+    if params['rcp'] == "historic":
+        aero = {
+                'so2_anth': '{stdat}/{cmip}/{rcp}/IPCC_emissions_SO2_anthropogenic_{ddyear}*.nc',
+                'so2_ship': '{stdat}/{cmip}/{rcp}/IPCC_emissions_SO2_ships_{ddyear}*.nc',
+                'so2_biom': '{stdat}/{cmip}/{rcp}/IPCC_GriddedBiomassBurningEmissions_SO2_decadalmonthlymean{ddyear}*.nc',
+                'bc_anth':  '{stdat}/{cmip}/{rcp}/IPCC_emissions_BC_anthropogenic_{ddyear}*.nc',
+                'bc_ship':  '{stdat}/{cmip}/{rcp}/IPCC_emissions_BC_ships_{ddyear}*.nc',
+                'bc_biom':  '{stdat}/{cmip}/{rcp}/IPCC_GriddedBiomassBurningEmissions_BC_decadalmonthlymean{ddyear}*.nc',
+                'oc_anth':  '{stdat}/{cmip}/{rcp}/IPCC_emissions_OC_anthropogenic_{ddyear}*.nc',
+                'oc_ship':  '{stdat}/{cmip}/{rcp}/IPCC_emissions_OC_ships_{ddyear}*.nc',
+                'oc_biom':  '{stdat}/{cmip}/{rcp}/IPCC_GriddedBiomassBurningEmissions_OC_decadalmonthlymean{ddyear}*.nc'}
+
+    elif iyr >= 2010 :
+        aero = {
+                'so2_anth': '{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_SO2_anthropogenic_{ddyear}*.nc',
+                'so2_ship': '{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_SO2_ships_{ddyear}*.nc',
+                'so2_biom': '{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_SO2_biomassburning_{ddyear}*.nc',
+                'bc_anth':  '{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_BC_anthropogenic_{ddyear}*.nc',
+                'bc_ship':  '{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_BC_ships_{ddyear}*.nc',
+                'bc_biom':  '{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_BC_biomassburning_{ddyear}*.nc',
+                'oc_anth':  '{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_OC_anthropogenic_{ddyear}*.nc',
+                'oc_ship':  '{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_OC_ships_{ddyear}*.nc',
+                'oc_biom':  '{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_OC_biomassburning_{ddyear}*.nc'}
+    else:
+        aero = {
+                'so2_anth': '{stdat}/{cmip}/historic/IPCC_emissions_SO2_anthropogenic_{ddyear}*.nc',
+                'so2_ship': '{stdat}/{cmip}/historic/IPCC_emissions_SO2_ships_{ddyear}*.nc',
+                'so2_biom': '{stdat}/{cmip}/historic/IPCC_GriddedBiomassBurningEmissions_SO2_decadalmonthlymean{ddyear}*.nc',
+                'bc_anth':  '{stdat}/{cmip}/historic/IPCC_emissions_BC_anthropogenic_{ddyear}*.nc',
+                'bc_ship':  '{stdat}/{cmip}/historic/IPCC_emissions_BC_ships_{ddyear}*.nc',
+                'bc_biom':  '{stdat}/{cmip}/historic/IPCC_GriddedBiomassBurningEmissions_BC_decadalmonthlymean{ddyear}*.nc',
+                'oc_anth':  '{stdat}/{cmip}/historic/IPCC_emissions_OC_anthropogenic_{ddyear}*.nc',
+                'oc_ship':  '{stdat}/{cmip}/historic/IPCC_emissions_OC_ships_{ddyear}*.nc',
+                'oc_biom':  '{stdat}/{cmip}/historic/IPCC_GriddedBiomassBurningEmissions_OC_decadalmonthlymean{ddyear}*.nc'}
+
+    for key in aero:
+        aero[key] = get_fpath(dict2str(aero[key].replace('{ddyear}',ddyear),params))
+
+    aero['volcano'] = dict2str('{stdat}/contineous_volc.nc',params)
+    aero['dmsfile'] = dict2str('{stdat}/dmsemiss.nc',params)
+    aero['dustfile'] = dict2str('{stdat}/ginoux.nc',params)
+
+    return aero
+
+def create_aeroemiss_file():
+    "Write arguments to 'aeroemiss' namelist file"
+
+    if d['aero'] == 1:
+        write2file('aeroemiss.nml',aeroemiss_template(),mode='w+')
+
+def create_sulffile_file():
+    """Create the aerosol forcing file, reusing a previously generated file for the
+    same domain, month and emission files from {vegca}/aerocache"""
+
+    if d['aero'] == 0:
+        return
+
+    # Remove any existing sulffile:
+    remove_files('{sulffile}')
+
+    cached = os.path.join(d['vegca'],'aerocache',dict2str('aero{domain}.{imth_2digit}.')+aero_cache_key()+'.nc')
+
+    if os.path.exists(cached):
+        print "Using cached aerosol forcing "+cached
+        shutil.copyfile(cached,d['sulffile'])
+        return
+
+    # Create new sulffile:
+    run_cmd(['{aeroemiss}','-o','{sulffile}'],stdin='aeroemiss.nml',stdout='aero.log')
+
+    if not(os.path.isdir(os.path.dirname(cached))):
+        os.makedirs(os.path.dirname(cached))
+
+    tmpname = cached+'.tmp.'+str(os.getpid())
+    shutil.copyfile(d['sulffile'],tmpname)
+    os.rename(tmpname,cached)
+
+def aero_cache_key():
+    """Hash of the aeroemiss namelist (month, topography and resolved emission files)
+    and of the size and modification time of each input file"""
+
+    sha = hashlib.sha1()
+    sha.update(dict2str(aeroemiss_template()))
+
+    for fname in [dict2str('{vegin}/topout{domain}')]+[d[key] for key in sorted(aero_keys)]:
+        stat = os.stat(fname)
+        sha.update(fname+' '+str(stat.st_size)+' '+str(int(stat.st_mtime))+'\n')
+
+    return sha.hexdigest()[:16]
+
+def create_input_file():
+    "Write the CCAM 'input' namelist file in a single write"
+
+    text = render(input_template(d['conv']))
+    diff_namelist('input',text)
+
+    with open('input','w') as ofile:
+        ofile.write(text)
+
+def input_template(conv):
+    "Template for the CCAM 'input' namelist file for the convection scheme conv"
+
+    if conv == 0:
+        template = input_template_2()
+
+    elif conv == 1:
+        template = input_template_3()
+
+    elif conv == 2:
+        template = input_template_4()
+
+    return input_template_1() + template + input_template_5()
+
+def diff_namelist(fname,text):
+    """Log the namelist settings that differ from the previous month's file to
+    {hdir}/namelists.log, warning about changes that are not date-dependent"""
+
+    if not(os.path.exists(fname)):
+        return
+
+    old = dict(re_nml_setting.findall(open(fname).read()))
+    new = dict(re_nml_setting.findall(text))
+    changed = sorted(key for key in set(old) | set(new) if old.get(key) != new.get(key))
+
+    with open(dict2str('{hdir}/namelists.log'),'a') as ofile:
+        ofile.write(dict2str('{iyr}{imth_2digit} ')+fname+': '+
+                    ' '.join(key+'='+str(new.get(key)) for key in changed)+'\n')
+
+    unexpected = [key for key in changed if key not in nml_date_keys]
+    if unexpected:
+        print "WARNING: "+fname+" settings changed since the previous month: "+', '.join(unexpected)
+
+def month_config_stages():
+    "Stages that derive the month's configuration in a context, see month_context()"
+
+    return [prep_iofiles, set_mlev_params, config_initconds, set_nudging,
+            set_downscaling, set_cloud, set_river, set_ocean, set_atmos,
+            set_surfc, set_aeros]
+
+def check_templates(config):
+    """Derive the context of the first month and check that every namelist template
+    of the run can be filled, before any model launch"""
+
+    iyr, imth = start_date()
+    if iyr*100+imth > config.iye*100+config.ime:
+        return
+
+    context = month_context(config,iyr,imth,config.ncountmax)
+    resolve_inputs(context)
+    context = postproc_context(context,context['seg_months'][0])
+
+    templates = [input_template(config.conv)]
+
+    if config.aero == 1:
+        templates.append(aeroemiss_template())
+
+    if config.ncout == 1:
+        templates.append(cc_template_1())
+
+    if config.ncout == 2:
+        templates.append(cc_template_2())
+
+    if config.ncsurf in [1,2]:
+        templates.append(cc_template_4())
+
+    if config.ncsurf == 1 and config.surfpp == 'python':
+        templates.append(cc_template_5())
+
+    missing = set()
+    for template in templates:
+        missing |= compile_template(template) - set(context)
+
+    # keys set per day by run_ctm_extraction()
+    if config.ncout == 3:
+        missing |= compile_template(cc_template_3()) - set(context) - set(['cday','istart','iend','outctmfile'])
+
+    if missing:
+        raise ValueError('Namelist templates use undefined keys: '+', '.join(sorted(missing)))
+
+def prepare_ccam_infiles():
+    "Prepare and check CCAM input data"
+
+    wait_staging()
+    stagedhost = staged_host()
+
+    if d['dmode'] == 0 or d['dmode'] == 2:
+        fpath = dict2str('{bcdir}/{mesonest}')
+
+        if stagedhost:
+            print "Using prefetched host files from "+stagedhost
+            link_files(stagedhost+'/{mesonest}*','.')
+
+        elif d['bcdom'] == "ccam_eraint_":
+            check_file_exists(fpath)
+            link_files(fpath,'.')
+
+        elif os.path.exists(fpath+'.000000'):
+            link_files(fpath+'.??????','.')
+
+        else:
+            check_file_exists(host_tar(fpath))
+            run_cmd(['tar','xvf',host_tar(fpath)])
+
+    if d['dmode'] == 1:
+        check_file_exists(dict2str('{sstinit}'))
+        link_files('{sstinit}','.')
+
+    if not(os.path.exists(d['ifile'])) and not(os.path.exists(d['ifile']+'.000000')):
+        raise ValueError(dict2str('Cannot locate {ifile} or {ifile}.000000. ')+
+                         'If this is the start of a new run, please check that year.qm has been deleted')
+
+    if d['dmode'] != 1:
+        if not(os.path.exists(d['mesonest'])) and not(os.path.exists(d['mesonest']+'.000000')):
+            raise ValueError(dict2str('Cannot locate {mesonest} or {mesonest}.000000'))
+
+    for file in ['topout{domain}', '{vegprev}', '{vegfile}', '{vegnext}', '{vegnextb}']:
+        check_file_exists(dict2str('{vegin}/'+file))
+
+    if d['nmlo'] != 0 and not(os.path.exists(dict2str('{vegin}/bath{domain}'))):
+        raise ValueError(dict2str('Cannot locate {vegin}/bath{domain}'))
+
+    if d['aero'] != 0 and not(os.path.exists(d['sulffile'])):
+        raise ValueError('Cannot locate '+d['sulffile'])
+
+    if d['dmode'] == 1 and not(os.path.exists(d['sstpath'])):
+        raise ValueError(dict2str('Cannot locate {sstpath}'))
+
+def host_tar(fpath):
+    "Path of the (possibly compressed) tar archive of a host file"
+
+    if os.path.exists(fpath+'.tar.gz') and not(os.path.exists(fpath+'.tar')):
+        return fpath+'.tar.gz'
+
+    return fpath+'.tar'
+
+def start_staging():
+    """Prefetch the inputs of the next model launch into stagedir in a background
+    worker, while the current launch integrates"""
+
+    global stage_worker
+
+    if d['stagedir'] == 'none':
+        return
+
+    last = d['seg_months'][-1]
+    iyr, imth = last['iyr'], last['imth']+1
+    if imth > 12:
+        iyr, imth = iyr+1, 1
+
+    if iyr*100+imth > d['iye']*100+d['ime']:
+        return
+
+    stage_worker = Process(target=stage_inputs,args=(iyr,imth),name='stage.'+str(iyr)+mon_2digit(imth))
+    stage_worker.start()
+
+def wait_staging():
+    "Wait for the background staging worker. A failed prefetch only disables the staged copy"
+
+    global stage_worker
+
+    if stage_worker is None:
+        return
+
+    worker = stage_worker
+    stage_worker = None
+    worker.join()
+
+    if worker.exitcode != 0:
+        print "WARNING: prefetch "+worker.name+" failed; inputs will be read from their original location"
+
+def stage_inputs(iyr,imth):
+    "Copy or extract the host, ozone and SST inputs for a month into stagedir"
+
+    stagedir = d['stagedir']
+    monthdir = os.path.join(stagedir,str(iyr)+mon_2digit(imth))
+
+    if d['dmode'] in [0,2] and not(os.path.exists(os.path.join(monthdir,'manifest.json'))):
+        fpath = os.path.join(d['bcdir'],mesonest_name(d,iyr,imth))
+        tmpdir = monthdir+'.tmp'
+
+        if os.path.isdir(tmpdir):
+            shutil.rmtree(tmpdir)
+        os.makedirs(tmpdir)
+
+        files = {}
+        if d['bcdom'] == "ccam_eraint_" or os.path.exists(fpath+'.000000'):
+            for fname in glob.glob(fpath)+glob.glob(fpath+'.??????'):
+                shutil.copyfile(fname,os.path.join(tmpdir,os.path.basename(fname)))
+                files[os.path.basename(fname)] = os.path.getsize(fname)
+        else:
+            tar = tarfile.open(host_tar(fpath))
+            for member in tar.getmembers():
+                if member.isfile():
+                    files[os.path.basename(member.name)] = member.size
+            tar.extractall(tmpdir)
+            tar.close()
+
+        if not files or not(verify_sizes(tmpdir,files)):
+            raise ValueError('Prefetch of '+fpath+' is incomplete')
+
+        with open(os.path.join(tmpdir,'manifest.json'),'w') as ofile:
+            json.dump({'source': fpath, 'files': files},ofile,indent=1,sort_keys=True)
+
+        os.rename(tmpdir,monthdir)
+
+    fnames = [ozone_name(d,iyr)]
+    if d['dmode'] == 1:
+        fnames.append(dict2str('{sstdir}/{sstfile}'))
+
+    for fname in fnames:
+        staged = os.path.join(stagedir,'common',os.path.basename(fname))
+        if os.path.exists(fname) and not(os.path.exists(staged) and os.path.getsize(staged) == os.path.getsize(fname)):
+            if not(os.path.isdir(os.path.dirname(staged))):
+                os.makedirs(os.path.dirname(staged))
+            shutil.copyfile(fname,staged+'.tmp')
+            os.rename(staged+'.tmp',staged)
+
+def staged_host():
+    "Directory of verified prefetched host files for the current month, or None"
+
+    if d['stagedir'] == 'none' or d['dmode'] == 1:
+        return None
+
+    monthdir = dict2str('{stagedir}/{iyr}{imth_2digit}')
+    manifest = os.path.join(monthdir,'manifest.json')
+
+    if not(os.path.exists(manifest)):
+        return None
+
+    if not(verify_sizes(monthdir,json.load(open(manifest))['files'])):
+        print "WARNING: prefetched host files in "+monthdir+" are incomplete"
+        return None
+
+    return monthdir
+
+def staged_copy(fname):
+    "Path of a verified prefetched copy of an input file, or the original path"
+
+    if d['stagedir'] == 'none':
+        return fname
+
+    staged = os.path.join(d['stagedir'],'common',os.path.basename(fname))
+
+    if os.path.exists(staged) and os.path.exists(fname) and os.path.getsize(staged) == os.path.getsize(fname):
+        return staged
+
+    return fname
+
+def verify_sizes(dirname,files):
+    "Check that files (name: size) exist in dirname with the expected sizes"
+
+    for fname, size in files.iteritems():
+        fpath = os.path.join(dirname,fname)
+        if not(os.path.exists(fpath)) or os.path.getsize(fpath) != size:
+            return False
+
+    return True
+
+def check_correct_host():
+    "Check if host is CCAM"
+
+    if d['dmode'] in [0,2]:
+        ccam_host = None
+        for fname in [d['mesonest'], d['mesonest']+'.000000']:
+            if os.path.exists(fname):
+                ccam_host = ('version' in read_nc_header(fname)['attrs'])
+                break
+        if ccam_host == True and d['dmode'] == 0:
+            raise ValueError('CCAM is the host model. Use dmode = 2')
+        elif ccam_host == False and d['dmode'] == 2:
+            raise ValueError('CCAM is not the host model. Use dmode = 0')
+
+def check_correct_landuse():
+    "Check that land-use data matches what the user wants"
+
+    fname = dict2str('{vegin}/{vegfile}')
+
+    attrs = read_nc_header(fname)['attrs']
+
+    cable_data = ('cableversion' in attrs)
+    if d['sib'] == 2 and cable_data == True:
+        raise ValueError('MODIS surface selected with sib=2, but CABLE data is in the input file')
+
+    modis_data = ('sibvegversion' in attrs)
+    if d['nsib'] == 1 and modis_data == True:
+        raise ValueError('CABLE surface selected with sib=1, but MODIS data is in the input file')
+
+def start_post_process():
+    """Post-process the month's output, either inline or in a background worker.
+    In pipeline mode the worker overlaps with the next month's model run; only the
+    restart file is shared between months and post-processing never touches it"""
+
+    global pp_worker
+
+    # only one month is post-processed at a time (cc.nml and logs are shared)
+    wait_post_process()
+
+    if d['pipeline'] == 0:
+        post_process_output()
+        return
+
+    print dict2str("Post-processing {ofile} in background")
+    pp_worker = Process(target=post_process_worker, args=(dict2str('{iyr}{imth_2digit}'),), name=dict2str('pp.{ofile}'))
+    pp_worker.start()
+
+def post_process_worker(month):
+    "Background post-processing, profiled separately from the driver"
+
+    reset_profile()
+    run_stage(post_process_output)
+    write_profile(month+'.pp')
+
+def wait_post_process():
+    "Wait for any background post-processing worker to finish"
+
+    global pp_worker
+
+    if pp_worker is None:
+        return
+
+    worker = pp_worker
+    pp_worker = None
+    worker.join()
+
+    if worker.exitcode != 0:
+        raise ValueError('Post-processing failed for '+worker.name+' (exit code '+str(worker.exitcode)+')')
+
+def run_model():
+    "Execute the CCAM model"
+
+    start = time.time()
+    run_cmd(d['mpi'].split()+['{nproc}','{model}'],stdout='prnew.{kdates}.{name}',stderr='err.{iyr}')
+    record_model_metrics(time.time()-start)
+    mark_stage_done('model',model_outputs())
+    remove_files('{mesonest}.??????','{mesonest}')
+
+    if d['stagedir'] != 'none':
+        remove_files('{stagedir}/{iyr}{imth_2digit}')
+
+def record_model_metrics(walltime):
+    """Append throughput metrics of the model launch to {hdir}/metrics.jsonl.
+    Called before the year-end clean-up removes the prnew logs"""
+
+    simdays = sum(month['ndays'] for month in d['seg_months'])
+    metrics = parse_model_log([dict2str('prnew.{kdates}.{name}'),dict2str('err.{iyr}')])
+
+    metrics.update({'month': dict2str('{iyr}{imth_2digit}'), 'name': d['name'], 'nproc': d['nproc'],
+                    'gridsize': d['gridsize'], 'mlev': d['mlev'], 'dt': d['dt'], 'nseg': d['nseg'],
+                    'simdays': simdays, 'wall': walltime,
+                    'sypd': (simdays/365.)/(walltime/86400.),
+                    'corehours_per_month': d['nproc']*walltime/3600./d['nseg'],
+                    'recorded': time.strftime('%Y-%m-%d %H:%M:%S')})
+
+    with open(dict2str('{hdir}/metrics.jsonl'),'a') as ofile:
+        ofile.write(json.dumps(metrics,sort_keys=True)+'\n')
+
+    print '{0}: {1:.2f} simulated years/day, {2:.1f} core-hours/month'.format(metrics['month'],metrics['sypd'],
+                                                                           metrics['corehours_per_month'])
+
+def parse_model_log(fnames):
+    """Extract timestep counts, timer breakdowns and per-process timings from globpea logs.
+    Timers are 'name value' lines after the end of the time loop; per-process timings are
+    lines that name a process (myid/rank/proc) followed by a time"""
+
+    metrics = {'ntimesteps': 0, 'timers': {}, 'rank_times': {}, 'normal_termination': False}
+
+    for fname in fnames:
+        if not(os.path.exists(fname)):
+            continue
+
+        endloop = False
+        for line in open(fname):
+            lower = line.lower()
+
+            for match in re_ktau.finditer(line):
+                metrics['ntimesteps'] = max(metrics['ntimesteps'],int(match.group(1)))
+
+            if 'normal termination' in lower:
+                metrics['normal_termination'] = True
+
+            if 'end of time loop' in lower or 'normal termination' in lower:
+                endloop = True
+                continue
+
+            match = re_rank_time.search(line)
+            if match:
+                rank = int(match.group(1))
+                metrics['rank_times'][rank] = max(metrics['rank_times'].get(rank,0.),float(match.group(2)))
+                continue
+
+            match = re_timer.match(line)
+            if endloop and match:
+                metrics['timers'][match.group(1).strip()] = float(match.group(2))
+
+    if metrics['rank_times']:
+        times = metrics['rank_times'].values()
+        metrics['rank_imbalance'] = max(times)/(sum(times)/len(times)) if sum(times) > 0. else 1.
+
+    return metrics
+
+def post_process_output():
+    """Post-process the CCAM model output.
+    The raw output of a launch may cover several months; each month is
+    extracted separately and the raw files are stored once"""
+
+    for month in d['seg_months']:
+        with bound(postproc_context(d,month)):
+            if stage_done('postproc'):
+                print dict2str("Post-processing of {iyr}{imth_2digit} is already complete")
+            else:
+                post_process_month()
+                mark_stage_done('postproc',glob_files('{hdir}/daily/*{histfile}.nc')+glob_files('{hdir}/daily/ctm_{iyr}{imth_2digit}.tar*'))
+
+            if d['rechunk'] == 1 and not(stage_done('rechunk')):
+                mark_stage_done('rechunk',rechunk_month())
+
+    if stage_done('archived'):
+        return
+
+    if d['ncsurf'] == 2 and d['nctar'] == 1:
+        archive_files('{hdir}/OUTPUT/surf.{ofile}.tar','surf.{ofile}.??????')
+        #remove_files('surf.{ofile}.??????')
+
+    # store output
+    if d['nctar'] == 0:
+        move_files('{ofile}.??????','{hdir}/OUTPUT')
+
+    elif d['nctar'] == 1:
+        archive_files('{hdir}/OUTPUT/{ofile}.tar','{ofile}.??????',remove=True)
+
+    mark_stage_done('archived',glob_files('{hdir}/OUTPUT/{ofile}.*')+glob_files('{hdir}/OUTPUT/surf.{ofile}.*'))
+
+def reset_state(config):
+    """Remove the stage markers of a previous run when this run starts from iys/ims
+    (no year.qm), so that a new run does not resume from them"""
+
+    statedir = os.path.join(config.hdir,'state')
+
+    if not(os.path.exists(os.path.join(config.hdir,'year.qm'))) and os.path.isdir(statedir):
+        print "Starting a new run; removing the stage markers of the previous run in "+statedir
+        shutil.rmtree(statedir)
+
+def stage_marker(stage):
+    "Path of the completion marker of a stage for the month in d"
+
+    return os.path.join(d['hdir'],'state',dict2str('{iyr}{imth_2digit}.')+stage+'.json')
+
+def mark_stage_done(stage,files=[]):
+    """Atomically record that a stage completed for the month in d, with the sizes of
+    the files it produced so that partial or damaged outputs can be detected"""
+
+    fname = stage_marker(stage)
+    if not(os.path.isdir(os.path.dirname(fname))):
+        os.makedirs(os.path.dirname(fname))
+
+    record = {'stage': stage, 'iyr': d['iyr'], 'imth': d['imth'], 'nseg': d['nseg'], 'kdates': d['kdates'],
+              'files': dict((os.path.abspath(ofile), os.path.getsize(ofile)) for ofile in files),
+              'completed': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+    with open(fname+'.tmp','w') as ofile:
+        json.dump(record,ofile,indent=1,sort_keys=True)
+    os.rename(fname+'.tmp',fname)
+
+    if os.path.exists(fname+'.invalid'):
+        os.remove(fname+'.invalid')
+
+def stage_done(stage):
+    """Check whether a stage completed for the month in d and its outputs are intact.
+    A model run that finished without being recorded (e.g. the job was killed just
+    after) is recognised from its log and restart files, unless a marker of that
+    run was already found to be damaged"""
+
+    fname = stage_marker(stage)
+
+    if stage == 'model' and not(os.path.exists(fname)) and not(os.path.exists(fname+'.invalid')) and model_completed():
+        print dict2str("Found a completed model run for {iyr}{imth_2digit}")
+        mark_stage_done('model',model_outputs())
+
+    if not(os.path.exists(fname)):
+        return False
+
+    record = json.load(open(fname))
+
+    # a marker of a different launch (e.g. another nseg) does not apply to this one
+    if record.get('kdates') != d['kdates'] or record['nseg'] != d['nseg']:
+        print "WARNING: "+fname+" was recorded for a different launch; repeating the stage"
+        os.rename(fname,fname+'.invalid')
+        return False
+
+    if not(verify_sizes('',record['files'])):
+        print "WARNING: outputs recorded in "+fname+" are missing or incomplete; repeating the stage"
+        os.rename(fname,fname+'.invalid')
+        return False
+
+    return True
+
+def model_outputs():
+    "Raw output and restart files written by the model for the launch in d"
+
+    return glob_files('{ofile}.??????')+glob_files('surf.{ofile}.??????')+glob_files('{restfile}.??????')
+
+def model_completed():
+    "Check the model log and files for a complete run of the launch in d"
+
+    fnames = [dict2str('prnew.{kdates}.{name}'),dict2str('err.{iyr}')]
+
+    return (os.path.exists(dict2str('{ofile}.000000')) and os.path.exists(dict2str('{restfile}.000000'))
+            and parse_model_log(fnames)['normal_termination'])
+
+def recover_post_processing(config):
+    """Finish the post-processing of launches whose model run completed but whose output
+    was never archived, e.g. a background post-processing job that failed or was killed"""
+
+    for fname in sorted(glob.glob(os.path.join(config.hdir,'state','*.model.json'))):
+        record = json.load(open(fname))
+        context = month_context(config,record['iyr'],record['imth'],record['nseg'])
+
+        with bound(context):
+            if os.path.exists(stage_marker('archived')):
+                continue
+
+            if stage_done('model'):
+                print dict2str("Recovering post-processing of {iyr}{imth_2digit}")
+                post_process_output()
+
+def postproc_context(context,month):
+    """Context for post-processing one month of the raw output of a launch: its date and
+    output time window. Times are relative to the start of the launch; the last month
+    is left open-ended"""
+
+    context = dict(context)
+    context.update({'iyr': month['iyr'], 'imth': month['imth'], 'ndays': month['ndays'], 'offset': month['offset'],
+                    'imth_2digit': mon_2digit(month['imth'])})
+    context['histfile'] = context['name']+'.'+str(month['iyr'])+context['imth_2digit']
+
+    context['ktc_sec'] = context['ktc_surf']*60
+
+    context['kta'] = month['offset']*1440 + context['ktc']
+    context['kta_sec'] = month['offset']*86400 + context['ktc_sec']
+    context['ktb'] = 999999
+    context['ktb_sec'] = 2999999
+
+    if month != context['seg_months'][-1]:
+        context['ktb'] = (month['offset']+month['ndays'])*1440
+        context['ktb_sec'] = (month['offset']+month['ndays'])*86400
+
+    return context
+
+def post_process_month():
+    "Convert one month of the CCAM model output with pcc2hist"
+
+    if d['ncout'] == 1:
+        write2file('cc.nml',cc_template_1(),mode='w+')
+        run_cmd(d['ppmpi'].split()+['{ppnproc}','{pcc2hist}'],stdout='pcc2hist.log')
+
+    if d['ncout'] == 2:
+        write2file('cc.nml',cc_template_2(),mode='w+')
+        run_cmd(d['ppmpi'].split()+['{ppnproc}','{pcc2hist}','--cordex'],stdout='pcc2hist.log')
+
+    if d['ncout'] in [1,2] and d['stats'] == 1:
+        output_stats(dict2str('{hdir}/daily/{histfile}.nc'))
+
+    if d['ncout'] == 3:
+        if d['sib'] == 2:
+            run_ctm_extraction()
+            archive_files('{hdir}/daily/ctm_{iyr}{imth_2digit}.tar','ctm_{iyr}{imth_2digit}??.nc',remove=True)
+
+        else:
+            raise ValueError(dict2str("Invalid land-use option for CTM sib={sib}. Please use sib=2 for CTM output"))
+
+    # surface files
+
+    if d['ncsurf'] == 1 and not(d['surfpp'] == 'python' and regrid_surface()):
+        write2file('cc.nml',cc_template_4(),mode='w+')
+        run_cmd(d['ppmpi'].split()+['{ppnproc}','{pcc2hist}'],stdout='surf.pcc2hist.log')
+        #remove_files('surf.{ofile}.??????')
+
+        if d['stats'] == 1:
+            output_stats(dict2str('{hdir}/daily/surf.{histfile}.nc'))
+
+def run_ctm_extraction():
+    """Extract the daily CTM files with a pool of concurrent pcc2hist jobs.
+    Each day gets its own directory and cc.nml, and runs on ctmnproc ranks"""
+
+    njobs = max(1, d['ppnproc'] / d['ctmnproc'])
+    days = range(1,d['ndays']+1)
+    running = []
+    failed = []
+
+    print dict2str("Extracting {ndays} CTM days with ")+str(njobs)+" concurrent pcc2hist jobs"
+
+    while days or running:
+
+        # launch new days while ranks are free
+        while days and len(running) < njobs:
+            iday = days.pop(0)
+            d['cday'] = mon_2digit(iday)
+            d['iend'] = (d['offset']+iday)*1440
+            d['istart'] = ((d['offset']+iday)*1440)-1440
+            d['outctmfile'] = dict2str('ctm_{iyr}{imth_2digit}{cday}.nc')
+            daydir = dict2str('ctm.{iyr}{imth_2digit}{cday}')
+
+            if not(os.path.isdir(daydir)):
+                os.mkdir(daydir)
+
+            write2file(daydir+'/cc.nml',cc_template_3(),mode='w+')
+            proc = launch_cmd(d['ppmpi'].split()+['{ctmnproc}','{pcc2hist}'],stdout='pcc2hist_ctm.log',cwd=daydir)
+            running.append((daydir,proc))
+
+        time.sleep(1)
+
+        for daydir, proc in running[:]:
+            if poll_cmd(proc) is not None:
+                running.remove((daydir,proc))
+                if wait_cmd(proc,check=False) != 0:
+                    failed.append(daydir)
+                else:
+                    shutil.rmtree(daydir)
+
+    if failed:
+        raise ValueError('pcc2hist failed for CTM days: '+', '.join(failed)+' (see pcc2hist_ctm.log in each directory)')
+
+def regrid_surface():
+    """Interpolate the month's high-frequency surface output to the output lat/lon grid
+    in Python instead of pcc2hist (ncsurf=1, surfpp=python). Interpolation weights are
+    computed once per domain, box and resolution and kept in the weight store.
+    Wind components and direction are relative to the cubic panel axes, so they
+    are left to pcc2hist, which rotates them, in {hdir}/daily/surfwind.{histfile}.nc.
+    Returns False (use pcc2hist) if the raw files do not contain grid coordinates"""
+
+    start = time.time()
+
+    with TileDataset(dict2str('surf.{ofile}.??????')) as tiles:
+        coords = tiles.coordinates()
+        if coords is None:
+            print "WARNING: no grid coordinates in surface output; using pcc2hist"
+            return False
+
+        lats, lons = output_grid()
+        weights = get_weights(np.radians(coords[0]),np.radians(coords[1]),lats,lons)
+        write_regridded(tiles,weights,dict2str('{hdir}/daily/surf.{histfile}.nc'))
+        winds = [name for name in surf_winds if name in tiles.variables]
+
+    log_cmd(['regrid_surface',dict2str('surf.{histfile}.nc')]+tiles.fnames,0,time.time()-start)
+
+    if winds:
+        write2file('cc.nml',cc_template_5(),mode='w+')
+        run_cmd(d['ppmpi'].split()+['{ppnproc}','{pcc2hist}'],stdout='surfwind.pcc2hist.log')
+
+        if d['stats'] == 1:
+            output_stats(dict2str('{hdir}/daily/surfwind.{histfile}.nc'))
+
+    return True
+
+class TileDataset(object):
+    """The per-rank output files of a launch ({ofile}.000000 ... {ofile}.NNNNNN) as one
+    dataset whose points are the points of all tiles in rank order. Nothing is read
+    up front: read() fetches only the requested times, levels and rows of each tile,
+    so fields can be sliced without copying or loading whole files. Usage:
+
+        with TileDataset('wdir/run.200001.??????') as tiles:
+            lon, lat = tiles.coordinates()
+            pts = tiles.region(150.,152.,-34.,-33.)
+            tscrn = tiles.read('tscrn',time=slice(0,24),points=pts)
+    """
+
+    def __init__(self,pattern):
+        self.fnames = sorted(glob.glob(pattern))
+
+        if not self.fnames:
+            raise ValueError('No output tiles match '+pattern)
+
+        self.tiles = [Dataset(fname,'r') for fname in self.fnames]
+        self.variables = self.tiles[0].variables.keys()
+
+        # horizontal size (rows, columns) of each tile and its first global point
+        self.shapes = [tuple(len(tile.dimensions[dim]) for dim in self.horizontal_dims(tile)) for tile in self.tiles]
+        self.offsets = np.cumsum([0]+[ny*nx for ny, nx in self.shapes])
+        self.npoints = self.offsets[-1]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def close(self):
+        for tile in self.tiles:
+            tile.close()
+
+    def horizontal_dims(self,tile):
+        "Names of the (row, column) dimensions of a tile: the last two of its 2D coordinates or fields"
+
+        for name in ['lon','longitude','xlon']+tile.variables.keys():
+            if name in tile.variables and tile.variables[name].ndim >= 2:
+                return tile.variables[name].dimensions[-2:]
+
+        raise ValueError('No 2D variables in output tile '+tile.filepath())
+
+    def coordinates(self):
+        "Longitudes and latitudes (degrees) of all points, or None if the tiles have no 2D coordinates"
+
+        for lon, lat in [('lon','lat'),('longitude','latitude'),('xlon','xlat')]:
+            if lon in self.variables and lat in self.variables and self.tiles[0].variables[lon].ndim >= 2:
+                return self.read(lon).astype(np.float64), self.read(lat).astype(np.float64)
+
+        return None
+
+    def times(self):
+        "Dates of the timesteps in the tiles"
+
+        tvar = self.tiles[0].variables['time']
+
+        return num2date(tvar[:],tvar.units,getattr(tvar,'calendar','standard'))
+
+    def region(self,minlon,maxlon,minlat,maxlat):
+        "Indices of the points inside a lon/lat box"
+
+        lon, lat = self.coordinates()
+        lon = np.where(lon < minlon,lon+360.,lon)
+
+        return np.nonzero((lon >= minlon) & (lon <= maxlon) & (lat >= minlat) & (lat <= maxlat))[0]
+
+    def read(self,name,time=slice(None),level=slice(None),points=None):
+        """Read a variable for the selected time(s) and level(s), at all points or at the
+        given point indices (in the order given): returns an array (..., npoints). Only
+        the rows of each tile that contain selected points are read"""
+
+        if points is not None:
+            # tiles are read in rank order; restore the order of points afterwards
+            points = np.asarray(points)
+            order = np.argsort(points,kind='mergesort')
+            inverse = np.empty_like(order)
+            inverse[order] = np.arange(len(order))
+            points = points[order]
+
+        results = []
+        for tile, (ny, nx), offset in zip(self.tiles,self.shapes,self.offsets):
+            var = tile.variables[name]
+            key = tuple(time if dim == 'time' else level for dim in var.dimensions[:-2])
+
+            if points is None:
+                data = var[key]
+                results.append(np.ma.asarray(data).reshape(data.shape[:-2]+(ny*nx,)))
+                continue
+
+            local = points[(points >= offset) & (points < offset+ny*nx)] - offset
+            if len(local) == 0:
+                continue
+
+            row0, row1 = local.min()/nx, local.max()/nx + 1
+            data = var[key+(slice(row0,row1),slice(None))]
+            data = np.ma.asarray(data).reshape(data.shape[:-2]+((row1-row0)*nx,))
+            results.append(data[...,local-row0*nx])
+
+        if points is not None:
+            return np.ma.concatenate(results,axis=-1)[...,inverse]
+
+        return np.ma.concatenate(results,axis=-1)
+
+def output_grid():
+    "Latitudes and longitudes (degrees) of the output grid: the box minlat..maxlat, minlon..maxlon at res"
+
+    lats = np.arange(d['minlat'],d['maxlat']+0.5*d['res'],d['res'])
+    lons = np.arange(d['minlon'],d['maxlon']+0.5*d['res'],d['res'])
+
+    return lats, lons
+
+def get_weights(srclon,srclat,lats,lons,npoints=4):
+    """Interpolation weights from source points (radians, in tile order) to a lat/lon grid
+    (degrees), from the weight store in weightdir. Entries are keyed by the domain, the
+    source points and the output grid, so they are shared by all products, months and
+    runs on the same domain and decomposition. Arrays are memory-mapped read-only"""
+
+    key = weight_key(srclon,srclat,lats,lons,npoints)
+    entry = os.path.join(weight_dir(),key)
+
+    if not(os.path.exists(os.path.join(entry,'meta.json'))):
+        index, weight = interp_weights(srclon,srclat,lons,lats,npoints)
+        store_weights(entry,index,weight,{'key': key, 'domain': d['domain'], 'nsrc': len(srclon),
+                                          'nlat': len(lats), 'nlon': len(lons), 'npoints': npoints,
+                                          'lats': [lats[0],lats[-1]], 'lons': [lons[0],lons[-1]]})
+
+    return load_weights(entry)
+
+def weight_dir():
+    "Directory of the interpolation weight store"
+
+    if d['weightdir'] == 'none':
+        return os.path.join(d['vegca'],'weights')
+
+    return d['weightdir']
+
+def weight_key(srclon,srclat,lats,lons,npoints):
+    "Hash identifying an interpolation: domain, source point coordinates, output grid and method"
+
+    sha = hashlib.sha1()
+    sha.update(d['domain']+' idw'+str(npoints)+'\n')
+
+    for array in [srclon,srclat,lats,lons]:
+        sha.update(np.ascontiguousarray(array,dtype=np.float64).tostring())
+
+    return sha.hexdigest()
+
+def store_weights(entry,index,weight,meta):
+    "Write a weight store entry as .npy files, under a private name renamed into place"
+
+    tmpentry = entry+'.tmp.'+str(os.getpid())
+    os.makedirs(tmpentry)
+
+    np.save(os.path.join(tmpentry,'index.npy'),index)
+    np.save(os.path.join(tmpentry,'weight.npy'),weight)
+    meta['created'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    with open(os.path.join(tmpentry,'meta.json'),'w') as ofile:
+        json.dump(meta,ofile,indent=1,sort_keys=True)
+
+    try:
+        os.rename(tmpentry,entry)
+    except OSError:
+        # another process stored the same entry first
+        shutil.rmtree(tmpentry)
+
+def load_weights(entry):
+    "Memory-map a weight store entry: {'index', 'weight', 'nlat', 'nlon', ...}"
+
+    weights = json.load(open(os.path.join(entry,'meta.json')))
+    weights['index'] = np.load(os.path.join(entry,'index.npy'),mmap_mode='r')
+    weights['weight'] = np.load(os.path.join(entry,'weight.npy'),mmap_mode='r')
+
+    return weights
+
+def regrid_field(weights,field):
+    """Interpolate a field whose last dimension holds the source points (in the order
+    used for the weights) to the lat/lon grid: returns shape (..., nlat, nlon)"""
+
+    result = apply_weights(weights['index'],weights['weight'],field)
+
+    return result.reshape(result.shape[:-1]+(weights['nlat'],weights['nlon']))
+
+def interp_weights(srclon,srclat,lons,lats,npoints=4):
+    """Inverse-distance weights of the npoints nearest source points (radians) for each
+    point of the lat/lon grid (degrees), as index and weight arrays of shape (nlat*nlon, npoints)"""
+
+    src = unit_vectors(srclon,srclat)
+    dlon, dlat = np.meshgrid(np.radians(lons),np.radians(lats))
+    dst = unit_vectors(dlon.ravel(),dlat.ravel())
+    npoints = min(npoints,len(src))
+
+    if cKDTree is not None:
+        dist, index = cKDTree(src).query(dst,k=npoints)
+        dist = dist.reshape(len(dst),npoints)
+        index = index.reshape(len(dst),npoints).astype(np.int32)
+
+    else:
+        index = np.empty((len(dst),npoints),dtype=np.int32)
+        dist = np.empty((len(dst),npoints),dtype=np.float64)
+
+        # brute force over blocks of output points, bounded to ~20 million distances at a time
+        block = max(1,20000000/len(src))
+        for i in xrange(0,len(dst),block):
+            chord = 2. - 2.*np.dot(dst[i:i+block],src.T)
+            nearest = np.argpartition(chord,npoints-1,axis=1)[:,:npoints]
+            index[i:i+block] = nearest
+            dist[i:i+block] = np.sqrt(np.maximum(chord[np.arange(len(nearest))[:,np.newaxis],nearest],0.))
+
+    weight = 1./np.maximum(dist,1.e-12)
+    weight = weight/weight.sum(axis=1)[:,np.newaxis]
+
+    return index, weight.astype(np.float32)
+
+def unit_vectors(lon,lat):
+    "Cartesian unit vectors of points on the sphere (radians)"
+
+    return np.column_stack([np.cos(lat)*np.cos(lon),np.cos(lat)*np.sin(lon),np.sin(lat)])
+
+def apply_weights(index,weight,field):
+    """Interpolate a field with the source points in its last dimension. Missing source
+    values are left out and the remaining weights renormalised; points without any
+    valid source value are returned as NaN"""
+
+    field = np.ma.masked_invalid(np.ma.asarray(field,dtype=np.float64))
+    values = field.filled(0.)[...,index]
+    valid = ~np.ma.getmaskarray(field)[...,index]
+
+    total = (weight*valid).sum(axis=-1)
+    result = (values*weight*valid).sum(axis=-1)
+
+    return np.where(total > 0.,result/np.where(total > 0.,total,1.),np.nan)
+
+def write_regridded(tiles,weights,ofile,chunk=48):
+    """Interpolate the surface fields of the month in d from the rank tiles (TileDataset)
+    to a lat/lon NetCDF file, streaming chunks of timesteps"""
+
+    lats, lons = output_grid()
+
+    # output times of this month (pcc2hist window: after the month start, up to its end),
+    # compared as numbers in the calendar of the file
+    tvar = tiles.tiles[0].variables['time']
+    dates = tiles.times()
+    calendar = getattr(tvar,'calendar','standard')
+    monthstart = date2num(datetime(d['iyr'],d['imth'],1),tvar.units,calendar)
+    monthend = date2num(datetime(d['iyr']+d['imth']/12,d['imth']%12+1,1),tvar.units,calendar)
+    steps = [n for n, value in enumerate(tvar[:]) if monthstart < value <= monthend]
+
+    scalars = [name for name in surf_names if not(name in surf_winds)]
+    names = [name for name in scalars if name in tiles.variables]
+    if len(names) < len(scalars):
+        print "WARNING: not in the surface output: "+', '.join(name for name in scalars if not(name in names))
+
+    tmpname = ofile+'.tmp'
+    out = Dataset(tmpname,'w',format='NETCDF4')
+    out.createDimension('time',None)
+    out.createDimension('lat',len(lats))
+    out.createDimension('lon',len(lons))
+
+    var = out.createVariable('lat','f8',('lat',))
+    var.units = 'degrees_north'
+    var[:] = lats
+    var = out.createVariable('lon','f8',('lon',))
+    var.units = 'degrees_east'
+    var[:] = lons
+
+    var = out.createVariable('time',tvar.dtype,('time',))
+    var.setncatts(dict((att, tvar.getncattr(att)) for att in tvar.ncattrs()))
+    var[:] = tvar[steps]
+
+    for name in names:
+        src = tiles.tiles[0].variables[name]
+        var = out.createVariable(name,'f4',('time','lat','lon'),zlib=True,fill_value=np.float32(1.e20))
+        var.setncatts(dict((att, src.getncattr(att)) for att in src.ncattrs() if att not in ['_FillValue','missing_value','scale_factor','add_offset']))
+
+    out.setncatts({'source': 'CCAM surface output interpolated by run_ccam.py', 'domain': d['domain'],
+                   'interpolation': 'inverse distance weighting of the 4 nearest model points (run_ccam.py surfpp=python)',
+                   'comment': 'wind fields ('+', '.join(surf_winds)+') are in surfwind.'+d['histfile']+'.nc, interpolated and rotated by pcc2hist'})
+
+    # statistics are accumulated from the interpolated fields as they are written
+    stats = OutputStats(out,names,ofile) if d['stats'] == 1 else None
+
+    for n in xrange(0,len(steps),chunk):
+        block = steps[n:n+chunk]
+        for name in names:
+            field = tiles.read(name,time=slice(block[0],block[-1]+1))
+            field = np.ma.masked_invalid(regrid_field(weights,field))
+            out.variables[name][n:n+len(block)] = field
+            if stats is not None:
+                stats.update(name,[dates[step] for step in block],field)
+
+    if stats is not None:
+        stats.close()
+
+    out.close()
+    os.rename(tmpname,ofile)
+
+def rechunk_month():
+    """Rewrite the post-processed output of the month in d as one file per variable in
+    {hdir}/timeseries, chunked for reading long time series at a few points (the whole
+    month of time by rechunk_shape lat/lon blocks). Variables are rewritten in parallel
+    by a pool of rechunk_workers processes on this node, each holding at most rechunk_mem
+    MB of data. Only the instantaneous products are rewritten, not the statistics.
+    Returns the files written"""
+
+    start = time.time()
+
+    outdir = dict2str('{hdir}/timeseries')
+    if not(os.path.isdir(outdir)):
+        os.makedirs(outdir)
+
+    jobs = []
+    for fname in glob_files('{hdir}/daily/{histfile}.nc')+glob_files('{hdir}/daily/surf*.{histfile}.nc'):
+        prefix = os.path.basename(fname)[:-len(dict2str('{histfile}.nc'))]
+        src = Dataset(fname,'r')
+        for name, var in src.variables.items():
+            # fields: the last two dimensions are horizontal coordinate axes
+            if not(name in src.dimensions) and var.ndim >= 2 and all(dim in src.variables and dim != 'time' for dim in var.dimensions[-2:]):
+                jobs.append((fname,name,os.path.join(outdir,prefix+name+dict2str('.{histfile}.nc'))))
+        src.close()
+
+    if not jobs:
+        return []
+
+    nworkers = max(1,min(len(jobs),d['rechunk_workers'],cpu_count()))
+    print dict2str("Rechunking {histfile} into ")+str(len(jobs))+" time series files with "+str(nworkers)+" workers"
+
+    pool = Pool(nworkers)
+    try:
+        pool.map(rechunk_variable,[job+(d['rechunk_shape'],d['deflate'],d['shuffle'],d['rechunk_mem']*2**20) for job in jobs])
+    finally:
+        pool.close()
+        pool.join()
+
+    ofiles = [job[2] for job in jobs]
+    log_cmd(['rechunk']+ofiles,0,time.time()-start)
+
+    return ofiles
+
+def rechunk_variable(args):
+    """Copy one variable (with its coordinates) to its own NetCDF4 file with the time axis
+    in a single chunk. Values are copied unpacked and unscaled, in bands of rows that
+    match the output chunks and fit within mem bytes where possible"""
+
+    fname, name, ofile, shape, deflate, shuffle, mem = args
+
+    src = Dataset(fname,'r')
+    src.set_auto_maskandscale(False)
+    svar = src.variables[name]
+
+    out = Dataset(ofile+'.tmp','w',format='NETCDF4')
+    out.setncatts(dict((att, src.getncattr(att)) for att in src.ncattrs()))
+
+    # coordinates of the variable and their bounds
+    coords = [dim for dim in svar.dimensions if dim in src.variables]
+    coords = coords + [src.variables[dim].bounds for dim in coords if getattr(src.variables[dim],'bounds','') in src.variables]
+    for dim in svar.dimensions + sum([src.variables[coord].dimensions for coord in coords],()):
+        if not(dim in out.dimensions):
+            out.createDimension(dim,len(src.dimensions[dim]))
+
+    for coord in coords:
+        cvar = src.variables[coord]
+        var = out.createVariable(coord,cvar.dtype,cvar.dimensions)
+        var.setncatts(dict((att, cvar.getncattr(att)) for att in cvar.ncattrs()))
+        var[:] = cvar[:]
+
+    # full time and level axes, lat/lon blocks of rechunk_shape
+    ntime, nlat, nlon = [int(size) for size in shape.split(',')]
+    chunks = list(svar.shape)
+    if svar.dimensions[0] == 'time' and ntime > 0:
+        chunks[0] = min(ntime,chunks[0])
+    chunks[-2] = min(nlat,chunks[-2])
+    chunks[-1] = min(nlon,chunks[-1])
+    chunks[1:-2] = [1]*len(chunks[1:-2])
+
+    fill = svar.getncattr('_FillValue') if '_FillValue' in svar.ncattrs() else None
+    var = out.createVariable(name,svar.dtype,svar.dimensions,zlib=deflate > 0,complevel=max(deflate,1),
+                             shuffle=shuffle == 1,chunksizes=chunks,fill_value=fill)
+    var.set_auto_maskandscale(False)
+    var.setncatts(dict((att, svar.getncattr(att)) for att in svar.ncattrs() if att != '_FillValue'))
+
+    # rows per band: a multiple of the chunk rows, at least one chunk
+    rowbytes = svar.dtype.itemsize*np.prod(svar.shape)/svar.shape[-2]
+    nrows = max(1,int(mem/max(rowbytes,1))/chunks[-2])*chunks[-2]
+    for row in xrange(0,svar.shape[-2],nrows):
+        band = (Ellipsis,slice(row,row+nrows),slice(None))
+        var[band] = svar[band]
+
+    out.close()
+    src.close()
+    os.rename(ofile+'.tmp',ofile)
+
+def output_stats(fname,chunk=48):
+    """Daily and monthly statistics of the fields of an output file of the month in d,
+    read back in blocks of timesteps after the file is written (a second pass over
+    pcc2hist output; regrid_surface accumulates its fields while writing instead)"""
+
+    start = time.time()
+
+    src = Dataset(fname,'r')
+    tvar = src.variables['time']
+    dates = num2date(tvar[:],tvar.units,getattr(tvar,'calendar','standard'))
+    names = [name for name, var in src.variables.items() if var.dimensions[:1] == ('time',) and var.ndim >= 3]
+
+    stats = OutputStats(src,names,fname)
+    for name in names:
+        for n in xrange(0,len(dates),chunk):
+            stats.update(name,dates[n:n+chunk],src.variables[name][n:n+chunk])
+        stats.finish(name)
+    stats.close()
+
+    src.close()
+    log_cmd(['output_stats',fname],0,time.time()-start)
+
+def stats_bins():
+    "Histogram bin edges for each variable in stats_hist ('name:lo:hi:nbins,...')"
+
+    bins = {}
+    if d['stats_hist'] == 'none':
+        return bins
+
+    for item in d['stats_hist'].split(','):
+        fields = item.split(':')
+        try:
+            lo, hi, nbins = float(fields[1]), float(fields[2]), int(fields[3])
+        except (IndexError, ValueError):
+            raise ValueError('Invalid stats_hist entry "'+item+'", expected name:lo:hi:nbins')
+        if len(fields) != 4 or hi <= lo or nbins < 1:
+            raise ValueError('Invalid stats_hist entry "'+item+'", expected name:lo:hi:nbins')
+        bins[fields[0]] = np.linspace(lo,hi,nbins+1)
+
+    return bins
+
+class StatsAccumulator(object):
+    """Running count, sum, minimum, maximum and (optionally) histogram of a field over
+    time at each point. Memory does not depend on the number of timesteps"""
+
+    def __init__(self,shape,edges=None):
+        self.count = np.zeros(shape,np.int32)
+        self.total = np.zeros(shape,np.float64)
+        self.minimum = np.empty(shape,np.float64)
+        self.minimum.fill(np.inf)
+        self.maximum = np.empty(shape,np.float64)
+        self.maximum.fill(-np.inf)
+        self.edges = edges
+        if edges is not None:
+            self.hist = np.zeros((len(edges)-1,)+tuple(shape),np.int32)
+
+    def update(self,field):
+        "Add the timesteps of field (time, ...); masked and NaN values are skipped"
+
+        field = np.ma.masked_invalid(np.ma.asarray(field,dtype=np.float64))
+        valid = ~np.ma.getmaskarray(field)
+
+        self.count += valid.sum(axis=0)
+        self.total += field.filled(0.).sum(axis=0)
+        self.minimum = np.minimum(self.minimum,field.filled(np.inf).min(axis=0))
+        self.maximum = np.maximum(self.maximum,field.filled(-np.inf).max(axis=0))
+
+        if self.edges is not None:
+            # values outside the range are counted in the first or last bin
+            npts = self.count.size
+            nbins = len(self.edges)-1
+            index = np.searchsorted(self.edges[1:-1],field.filled(0.),side='right').reshape(len(field),npts)
+            index = index*npts + np.arange(npts)
+            counts = np.bincount(index[valid.reshape(len(field),npts)],minlength=nbins*npts)
+            self.hist += counts.reshape(self.hist.shape).astype(np.int32)
+
+    def results(self):
+        "Mean, minimum, maximum and sum, masked where there were no valid values"
+
+        empty = self.count == 0
+        mean = self.total/np.maximum(self.count,1)
+
+        return dict((key, np.ma.masked_where(empty,value)) for key, value in
+                    [('mean',mean),('min',self.minimum),('max',self.maximum),('sum',self.total)])
+
+class OutputStats(object):
+    """Daily and monthly mean, minimum, maximum and sum (and histograms of the variables
+    in stats_hist) of the fields of an output file of the month in d, written to
+    daystats.* and monstats.* next to it. Fields are passed in blocks of timesteps with
+    update(); a timestep at midnight closes the previous day, as in the output window"""
+
+    def __init__(self,src,names,fname):
+        self.names = names
+        self.bins = stats_bins()
+        self.fnames = [os.path.join(os.path.dirname(fname),prefix+os.path.basename(fname)) for prefix in ['daystats.','monstats.']]
+        self.days = [self.create(src,self.fnames[0],np.arange(d['ndays'])+0.5), self.create(src,self.fnames[1],[0.5*d['ndays']])]
+        self.shapes = dict((name, src.variables[name].shape[1:]) for name in names)
+        self.daily = {}
+        self.monthly = {}
+        self.current = {}
+
+    def create(self,src,fname,times):
+        "Create a statistics file with the coordinates and attributes of the fields in src"
+
+        out = Dataset(fname+'.tmp','w',format='NETCDF4')
+        out.createDimension('time',len(times))
+
+        var = out.createVariable('time','f8',('time',))
+        var.units = 'days since '+dict2str('{iyr}-{imth_2digit}-01 00:00:00')
+        var.calendar = 'standard' if d['leap'] == 1 else 'noleap'
+        var[:] = times
+
+        for name in self.names:
+            src_var = src.variables[name]
+            for dim in src_var.dimensions[1:]:
+                if not(dim in out.dimensions):
+                    out.createDimension(dim,len(src.dimensions[dim]))
+                    if dim in src.variables:
+                        var = out.createVariable(dim,src.variables[dim].dtype,(dim,))
+                        var.setncatts(dict((att, src.variables[dim].getncattr(att)) for att in src.variables[dim].ncattrs()))
+                        var[:] = src.variables[dim][:]
+
+            atts = dict((att, src_var.getncattr(att)) for att in ['units','long_name'] if att in src_var.ncattrs())
+            for stat, method in [('mean','mean'),('min','minimum'),('max','maximum'),('sum','sum')]:
+                var = out.createVariable(name+'_'+stat,'f4',('time',)+src_var.dimensions[1:],zlib=True,fill_value=np.float32(1.e20))
+                var.setncatts(atts)
+                var.cell_methods = 'time: '+method
+
+            if name in self.bins:
+                edges = self.bins[name]
+                out.createDimension(name+'_bin',len(edges)-1)
+                var = out.createVariable(name+'_bin','f8',(name+'_bin',))
+                var.long_name = 'bin centre of '+name+' histogram (out of range values are counted in the end bins)'
+                var.bin_width = edges[1]-edges[0]
+                var[:] = 0.5*(edges[1:]+edges[:-1])
+                var = out.createVariable(name+'_hist','i4',('time',name+'_bin')+src_var.dimensions[1:],zlib=True)
+                var.long_name = 'number of timesteps in each bin of '+name
+
+        out.setncatts({'source': 'statistics of '+os.path.basename(fname)+' accumulated by run_ccam.py', 'domain': d['domain']})
+
+        return out
+
+    def update(self,name,dates,field):
+        "Add a block of timesteps of a field, with their dates"
+
+        days = []
+        for date in dates:
+            date = date - timedelta(seconds=1)
+            days.append(date.day-1 if (date.year, date.month) == (d['iyr'], d['imth']) else None)
+
+        # accumulate each run of timesteps from the same day at once
+        n = 0
+        while n < len(days):
+            end = n+1
+            while end < len(days) and days[end] == days[n]:
+                end += 1
+
+            if days[n] is not None:
+                if self.current.get(name) != days[n]:
+                    self.write_day(name)
+                    self.current[name] = days[n]
+                    self.daily[name] = StatsAccumulator(self.shapes[name],self.bins.get(name))
+
+                if not(name in self.monthly):
+                    self.monthly[name] = StatsAccumulator(self.shapes[name],self.bins.get(name))
+
+                self.daily[name].update(field[n:end])
+                self.monthly[name].update(field[n:end])
+
+            n = end
+
+    def write_day(self,name):
+        "Write the statistics of the current day of a field"
+
+        if name in self.daily:
+            self.write(self.days[0],name,self.current[name],self.daily.pop(name))
+
+    def finish(self,name):
+        "Write the remaining statistics of a field and release its accumulators"
+
+        self.write_day(name)
+        if name in self.monthly:
+            self.write(self.days[1],name,0,self.monthly.pop(name))
+
+    def write(self,out,name,index,accumulator):
+        "Write the statistics of an accumulator at a time index of a statistics file"
+
+        for stat, value in accumulator.results().iteritems():
+            out.variables[name+'_'+stat][index] = value
+        if accumulator.edges is not None:
+            out.variables[name+'_hist'][index] = accumulator.hist
+
+    def close(self):
+        "Write the remaining statistics and move the files into place"
+
+        for name in self.names:
+            self.finish(name)
+
+        for out, fname in zip(self.days,self.fnames):
+            out.close()
+            os.rename(fname+'.tmp',fname)
+
+def update_counter():
+    "Update counter for next simulation month and remove old files"
+
+    # update counter for next simulation month and remove old files
+    d['imth'] = d['imth'] + d['nseg']
+
+    if d['imth'] < 12:
+        remove_files('Rest{name}.{iyr}12.??????')
+
+    elif d['imth'] > 12:
+        archive_files('{hdir}/RESTART/Rest{name}.{iyr}12.tar','Rest{name}.{iyr}12*')
+        remove_files('Rest{name}.{iyr}0?.??????','Rest{name}.{iyr}10.??????','Rest{name}.{iyr}11.??????')
+        remove_files('prnew.{iyr}*')
+        remove_files('{name}*{iyr}??')
+        remove_files('{name}*{iyr}??.nc')
+        d['imth'] = 1
+        d['iyr'] = d['iyr'] + 1
+
+def update_yearqm():
+    "Update the year.qm file"
 
-    if d['ncout'] == 3 and d['sib'] != 2:
-        raise ValueError, "sib=2 is required for ctm output"
-        # I could simply hard-wire this here
+    d['yyyymm'] = d['iyr'] * 100 + d['imth']
+    write2file(d['hdir']+'/year.qm',"{yyyymm}",mode='w+')
 
-    if d['ncout'] == 3 and d['nstrength'] != 1:
-        raise ValueError, "nstrength=1 is required for ctm output"
+def parse_walltime(walltime):
+    """Seconds in a walltime given in the Slurm formats (MM, MM:SS, HH:MM:SS, D-HH, D-HH:MM,
+    D-HH:MM:SS), or None if not set or unlimited"""
 
-    d['plevs'] = d['plevs'].replace(',',', ')
+    if walltime in ['none','UNLIMITED','NOT_SET','INVALID','']:
+        return None
 
-def check_surface_files():
-    "Ensure surface datasets exist"
+    days = 0
+    if '-' in walltime:
+        days, walltime = walltime.split('-')
+        fields = [int(field) for field in walltime.split(':')]
+        fields = fields+[0]*(3-len(fields))
+    else:
+        fields = [int(field) for field in walltime.split(':')]
+        if len(fields) == 1:
+            fields = [0,fields[0],0]
+        elif len(fields) == 2:
+            fields = [0]+fields
 
-    d['domain'] = dict2str('{gridsize}_{midlon}_{midlat}_{gridres}km')
+    return int(days)*86400 + fields[0]*3600 + fields[1]*60 + fields[2]
 
-    for fname in ['topout','bath','casa']:
-        if not(os.path.exists(dict2str('{vegca}/'+fname+'{domain}'))):        
-            run_cable()
+def slurm_walltime():
+    "Time limit of the Slurm job this runs in, from squeue, or 'none' if not known"
 
-    for mon in xrange(1,13):
-        if not(os.path.exists(dict2str('{vegca}/veg{domain}.'+mon_2digit(mon)))):
-            run_cable()
+    if 'SLURM_JOB_ID' not in os.environ or find_executable('squeue') is None:
+        return 'none'
 
-def run_cable():
-    "Generate topography and land-use files for CCAM"
+    try:
+        limit = subprocess.check_output(['squeue','-h','-j',os.environ['SLURM_JOB_ID'],'-o','%l']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'none'
 
-    print "Generating topography file"
-    d['inv_schmidt'] = float(d['gridres']) * float(d['gridsize']) / (112. * 90.)
-    write2file('top.nml',top_template(),mode='w+')
-    run_cmdline('ulimit -s unlimited && {terread} < top.nml')
+    return limit or 'none'
 
-    print "Generating MODIS land-use data"
-    write2file('igbpveg.nml',igbpveg_template(),mode='w+')
-    run_cmdline('ulimit -s unlimited && {igbpveg} -s 1000 < igbpveg.nml')
-    run_cmdline('mv -f topsib{domain} topout{domain}')
+def job_time_left():
+    "Seconds left in the job's walltime, or None if the walltime is not known"
 
-    print "Processing bathymetry data"
-    run_cmdline('ln -s {insdir}/vegin/*.bil .')
-    write2file('ocnbath.nml',ocnbath_template(),mode='w+')
-    run_cmdline('ulimit -s unlimited && {ocnbath} -s 1000 < ocnbath.nml')
-    run_cmdline('rm -f *.bil')
+    walltime = parse_walltime(d['walltime'])
 
-    print "Processing CASA data"
-    run_cmdline('ulimit -s unlimited && {casafield} -t topout{domain} -i {insdir}/vegin/casaNP_gridinfo_1dx1d.nc -o casa{domain}')
+    if walltime is None:
+        return None
 
-    run_cmdline('mv -f topout{domain} {vegca}')
-    run_cmdline('mv -f veg{domain}* {vegca}')
-    run_cmdline('mv -f bath{domain} {vegca}')
-    run_cmdline('mv -f casa{domain} {vegca}')
+    return walltime - (time.time() - job_start)
 
-def create_directories():
-    "Create output directories and go to working directory"
+def seconds_per_month():
+    """Median wall time of one simulated month from the profiles of recent months, or None
+    before any month has been profiled. Only the stages of the month loop are counted (not
+    one-off setup such as run_cable), and only months whose model run was timed"""
 
-    os.chdir(dict2str('{hdir}'))
-    
-    for dirname in ['daily','OUTPUT','RESTART','vegdata','wdir']:
-        if not(os.path.isdir(dirname)):
-            os.mkdir(dirname)
-   
-    run_cmdline('rm -f {hdir}/restart.qm')
+    names = set(['get_datetime']+[stage.__name__ for stages in month_loop_stages() for stage in stages])
+    fnames = [fname for fname in glob.glob(dict2str('{hdir}/profile/profile.*.json')) if not(fname.endswith('.pp.json'))]
+    times = []
 
-    os.chdir('wdir')
+    for fname in sorted(fnames):
+        record = json.load(open(fname))
+        if 'run_model' in [stage['stage'] for stage in record['stages']]:
+            times.append(sum(stage['wall'] for stage in record['stages'] if stage['stage'] in names)/record.get('nseg',1))
 
-def calc_dt_out():
-    "Calculate model output timestep"
+    times = times[-6:]
 
-    d['dtout']=360  # raw cc output frequency (mins)
+    if not times:
+        return None
 
-    if d['ncout'] == 3:
-        d['dtout'] = 60 # need hourly output for CTM
+    return sorted(times)[len(times)/2]
 
-    if d['ktc'] < d['dtout']:
-        d['dtout'] = d['ktc']
+def size_ncountmax():
+    "Set ncountmax to the number of months that fit in the job's walltime, once timings exist"
 
-def read_inv_schmidt():
-    "Read inverse schmidt value from NetCDF topo file and calculate grid resolution"
+    timeleft = job_time_left()
+    permonth = seconds_per_month()
 
-    topofile = dict2str('{vegca}/topout{domain}')
-    check_file_exists(topofile)
-    d['topofile'] = topofile
+    if timeleft is None or permonth is None:
+        return
 
-    fread = Dataset(topofile,'r')
-    d['inv_schmidt'] = fread.schmidt
-    d['lon0'] = fread.lon0
-    d['lat0'] = fread.lat0
-    d['gridsize'] = len(fread.variables['longitude'])
-    fread.close()
+    ncount = max(1,int(timeleft*d['wallfrac']/permonth))
+    print "Walltime allows "+str(ncount)+" months at {0:.0f} s/month (ncountmax was {1})".format(permonth,d['ncountmax'])
+    d['ncountmax'] = ncount
 
-def calc_res():
-    "Calculate resolution for high resolution area"
+def time_for_month():
+    "Check that the walltime left (if known) allows another month at the measured rate"
 
-    gridres_m = d['gridres']*1000. # GRIDRES IN UNITS OF METERS
+    timeleft = job_time_left()
+    permonth = seconds_per_month()
 
-    res=d['reqres']
-    if res == -1.:
-        res = gridres_m/112000.
+    if timeleft is None or permonth is None:
+        return True
 
-    d['gridres'] = gridres_m
-    d['res'] = res
+    return timeleft*d['wallfrac'] > permonth
 
-    # CHECK
-    # 1. Should reqres be an input argument - how does this then relate to the pre-defind inv_schmidt?
-    # 2. Note above I have divided by 112000. The original code had 100000.
+def months_left():
+    "Number of months of the run not yet simulated, according to year.qm"
 
-def set_ktc_surf():
-    "Set tstep for high-frequency output"
+    fname = dict2str('{hdir}/year.qm')
+    if os.path.exists(fname) and open(fname).read().strip() == 'Complete':
+        return 0
 
-    if d['ncsurf'] == 0. :
-        d['ktc_surf'] = d['dtout']
+    iyr, imth = start_date()
 
-def calc_dt_mod():
-    """Calculate model timestep.
-     dt is a function of dx; dt out and ktc_surf must be integer multiples of dt"""
+    return max(0,(d['iye']-iyr)*12 + d['ime']-imth + 1)
 
-    # define dictionary of pre-defined dx (mtrs) : dt (sec) relationships
-    d_dxdt = {60000:1200, 45000:900, 36000:720,
-              30000:600, 18000:360, 15000:300,
-              12000:240, 9000:180, 6000:120, 4500:90,
-              4000:80, 3000:60, 2000:40, 1000:20,
-              500:10, 200:4, 100:2, 50:1}
+def submit_next_job(jobid=None,nleft=None):
+    """Submit the job script again for the next segment of the run. With a job id the
+    new job waits in the queue for this one to end successfully (afterok), so queue
+    waiting overlaps with this job; a failed job leaves the chain stopped.
+    nleft overrides the months left after this job (ensembles).
+    Returns the id of the new job, or None if none was submitted"""
 
-    # determine dt based on dx, dtout and ktc_surf
-    for dx in sorted(d_dxdt):
-        if ( d['gridres'] >= dx ) and ( 60 * d['dtout'] % d_dxdt[dx] == 0 ) and ( 60 * d['ktc_surf'] % d_dxdt[dx] == 0):
-            d['dt'] = d_dxdt[dx]
+    if d['resubmit'] == 'none':
+        return None
 
-    if d['gridres'] < 50:
-        raise ValueError, "Minimum grid resolution of 50m has been exceeded"
+    # months left after this job (queued with a dependency) or after it ended
+    if nleft is None:
+        nleft = months_left()
+        if jobid is not None:
+            nleft = nleft - d['ncountmax']
 
-    #if ( d['dtout'] % dt != 0 ):
-    #    raise ValueError, "dtout must be a multiple of dt" # CHECK: Original code has dtout must be a multiple of dt/60
-    #Is this not redundant code given that dt will be 1, above.
+    if nleft <= 0:
+        return None
 
-    if ( d['ktc'] % d['dtout'] != 0):
-        raise ValueError, "ktc must be a multiple of dtout"
+    args = d['sbatch'].split()
+    if jobid is not None:
+        args.append('--dependency=afterok:'+jobid)
+    args.append(d['resubmit'])
 
-    if d['ncsurf'] != 0:
-        if ( d['dtout'] % d['ktc_surf'] != 0): # This order is different to original code
-            raise ValueError, "dtout must be a multiple of ktc_surf"
+    output = capture_cmd(args)
+    match = re.search(r'(\d+)\s*$',output.strip())
+    newjob = match.group(1) if match else output.strip()
 
-def get_datetime():
-    "Determine relevant dates and timesteps for running model"
+    with open(dict2str('{hdir}/jobs.log'),'a') as ofile:
+        ofile.write('{0}  job={1} submitted={2} after={3}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'),
+                    os.environ.get('SLURM_JOB_ID','none'),newjob,jobid or 'none'))
 
-    # Load year.qm with current simulation year:
-    fname=dict2str('{hdir}/year.qm')
-    if (os.path.exists(fname)):
-        yyyydd = open(fname).read()
-        d['iyr']  = int(yyyydd[0:4])
-        d['imth'] = int(yyyydd[4:6])
-        print("ATTENTION:")
-        print(dict2str("Simulation start date taken from {hdir}/year.qm"))
-        print("Start date: "+str(d['iyr'])+mon_2digit(d['imth'])+'01')
-        print("If this is the incorrect start date, please delete year.qm")
-    else:
-        d['iyr']  = d['iys']
-        d['imth'] = d['ims']
+    print "Submitted next job "+newjob+(" (after "+jobid+")" if jobid else "")
 
-    # Abort run at finish year:
-    sdate = d['iyr']*100 +d['imth']
-    edate = d['iye']*100 +d['ime']
+    return newjob
 
-    if sdate > edate:
-        write2file(d['hdir']+'/year.qm',"Complete",mode='w+')
-        raise ValueError, 'CCAM simulation completed normally'
+def restart_flag():
+    "Create restart.qm containing flag for restart. This flag signifies that CCAM completed previous month"
 
-    iyr = d['iyr']
-    imth = d['imth']
+    write2file(d['hdir']+'/restart.qm',"True",mode='w+')
 
-    # Decade start and end:
-    d['ddyear'] = iyr/10*10
-    d['deyear'] = d['ddyear'] + 9
 
-    # Calculate previous month:
-    if imth == 1:
-        d['imthlst'] = '12'
-        d['iyrlst']  = iyr-1
-    else:
-        d['imthlst'] = imth-1
-        d['iyrlst']  = iyr
+def run_cmd(args,stdin=None,stdout=None,stderr=None,cwd=None,check=True):
+    "Run a command (argument list, no shell), recording its wall time and exit status"
 
-    # Calculate the next month:
-    if imth == 12:
-        d['imthnxt'] = 1
-        d['iyrnxt'] = iyr+1
-    else:
-        d['imthnxt'] = imth+1
-        d['iyrnxt'] = iyr
+    return wait_cmd(launch_cmd(args,stdin,stdout,stderr,cwd),check)
 
-    # Calculate the next next month (+2):
-    if imth > 10:
-        d['imthnxtb'] = imth-10
-    else:
-        d['imthnxtb'] = imth+2
+def launch_cmd(args,stdin=None,stdout=None,stderr=None,cwd=None):
+    """Start a command (argument list, no shell) and return a handle for wait_cmd.
+    Arguments and redirection file names are formatted with dict2str; redirection
+    file names are relative to cwd"""
 
-    d['imthlst_2digit'] = mon_2digit(d['imthlst'])
-    d['imth_2digit'] = mon_2digit(d['imth'])
-    d['imthnxt_2digit'] = mon_2digit(d['imthnxt'])
-    d['imthnxtb_2digit'] = mon_2digit(d['imthnxtb'])
+    args = [dict2str(arg) for arg in args]
+    files = {}
 
-   # Calculate number of days in current month:
-    d['ndays']=monthrange(iyr,imth)[1]
+    for key, fname, fmode in [('stdin',stdin,'r'),('stdout',stdout,'w'),('stderr',stderr,'w')]:
+        if fname is None or fname == subprocess.PIPE:
+            files[key] = fname
+        else:
+            files[key] = open(os.path.join(cwd or '',dict2str(fname)),fmode)
 
-    if (imth == 2) and (d['leap'] == 0):
-        d['ndays']=28 #leap year turned off
+    proc = subprocess.Popen(args,stdin=files['stdin'],stdout=files['stdout'],stderr=files['stderr'],
+                            cwd=cwd,preexec_fn=unlimit_stack,close_fds=True)
 
-    # Number of steps between output:
-    d['nwt'] = d['dtout']*60/d['dt']
+    return {'args': args, 'proc': proc, 'files': files, 'start': time.time(),
+            'stdout': dict2str(stdout) if isinstance(stdout,str) else None}
 
-    # Number of steps in run:
-    d['ntau'] = d['ndays']*86400/d['dt']
+def wait_cmd(handle,check=True):
+    "Wait for a command started by launch_cmd, log its timing and stop the run if it failed"
 
-    # Start date string:
-    d['kdates']=str(d['iyr']*10000 + d['imth']*100 + 01)
+    proc = handle['proc']
+    poll_cmd(handle,block=True)
 
-def prep_iofiles():
-    "Prepare input and output files"
+    for ofile in handle['files'].values():
+        if hasattr(ofile,'close'):
+            ofile.close()
 
-    # Define restart file:
-    d['ifile'] = dict2str('Rest{name}.{iyrlst}{imthlst_2digit}')
-    d['ofile'] = dict2str('{name}.{iyr}{imth_2digit}')
+    rusage = handle['rusage']
+    log_cmd(handle['args'],proc.returncode,handle['end']-handle['start'],
+            rusage.ru_utime+rusage.ru_stime,rusage.ru_oublock*512,handle['stdout'])
 
-    # Define host model fields:
-    d['mesonest'] = dict2str('{bcdom}.{iyr}{imth_2digit}')
+    if check and proc.returncode != 0:
+        raise ValueError('Command failed with exit code '+str(proc.returncode)+': '+' '.join(handle['args']))
 
-    if d['bcdom'] == 'ccam_eraint_':
-        d['mesonest'] = dict2str('{bcdom}{iyr}{imth_2digit}.nc')
+    return proc.returncode
 
-    # Define restart file:
-    d['restfile'] = dict2str('Rest{name}.{iyr}{imth_2digit}')
+def poll_cmd(handle,block=False):
+    """Reap a command started by launch_cmd if it has finished, keeping its resource usage.
+    Returns the exit code, or None if the command is still running"""
 
-    # Define ozone infile:
-    if d['rcp'] == "historic" or d['iyr'] < 2005 :
-        d['ozone'] = dict2str('{stdat}/{cmip}/historic/pp.Ozone_CMIP5_ACC_SPARC_{ddyear}-{deyear}_historic_T3M_O3.nc')
-    else:
-        d['ozone'] = dict2str('{stdat}/{cmip}/{rcp}/pp.Ozone_CMIP5_ACC_SPARC_{ddyear}-{deyear}_{rcp}_T3M_O3.nc')
+    proc = handle['proc']
 
-    # Define CO2 infile:
-    d['co2file']= dict2str('{stdat}/{cmip}/{rcp}_MIDYR_CONC.DAT')
+    if proc.returncode is None:
+        pid, status, rusage = os.wait4(proc.pid,0 if block else os.WNOHANG)
+        if pid == 0:
+            return None
 
-    for fname in [d['ozone'],d['co2file']]:
-        check_file_exists(fname)
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
 
-def set_mlev_params():
-    "Set the parameters related to the number of model levels"
+        handle['end'] = time.time()
+        handle['rusage'] = rusage
 
-    d_mlev_eigenv = {27:"eigenv27-10.300", 35:"eigenv.35b", 54:"eigenv.54b", 72:"eigenv.72b", 108:"eigenv.108b", 144:"eigenv.144b"}
-    d_mlev_modlolvl = {27:20, 35:30, 54:40, 72:60, 108:80, 144:100}
+    return proc.returncode
 
-    d.update({'nmr': 1, 'acon': 0.00, 'bcon': 0.04, 'eigenv': d_mlev_eigenv[d['mlev']], 'mlolvl': d_mlev_modlolvl[d['mlev']]})
+def capture_cmd(args):
+    "Run a command (argument list, no shell) and return its standard output"
 
-def config_initconds():
-    "Configure initial condition file"
+    handle = launch_cmd(args,stdout=subprocess.PIPE)
+    output = handle['proc'].stdout.read()
+    handle['proc'].stdout.close()
+    wait_cmd(handle)
 
-    d['nrungcm'] = 0
+    return output
 
-    if d['iyr'] == d['iys'] and d['imth'] == d['ims']:
+def log_cmd(args,returncode,walltime,cputime=0.,nbytes=0,stdout=None):
+    """Append the exit status, wall time and CPU time of a command to {hdir}/commands.log
+    and to the profile of the current month"""
 
-        d['nrungcm'] = -1
+    line = '{0}  exit={1:<4d} {2:10.2f}s {3:10.2f}s cpu  {4}\n'.format(time.strftime('%Y-%m-%d %H:%M:%S'),
+                                                      returncode,walltime,cputime,' '.join(args))
 
-        if d['dmode'] in [0,2]:
-            d.update({'ifile': d['mesonest']})
-        else:
-            d.update({'ifile': d['sstinit']})
+    with open(dict2str('{hdir}/commands.log'),'a') as ofile:
+        ofile.write(line)
 
-def set_nudging():
-    "Set nudging strength parameters"
+    profile['commands'].append({'command': command_name(args), 'args': ' '.join(args), 'exit': returncode,
+                                'wall': walltime, 'cpu_children': cputime, 'bytes_written': nbytes,
+                                'stdout': stdout})
 
-    if d['nstrength'] == 0:
-        d.update({'mbd_base': 20, 'mbd_maxgrid': 999999, 'mbd_maxscale': 3000,
-                'kbotdav': -900, 'sigramplow': 0.05})
+def command_nproc(args,command):
+    "Number of ranks an MPI command line (string) ran command on: the count before the executable, or None"
 
-    elif d['nstrength'] == 1:
-        d.update({'mbd_base': 20, 'mbd_maxgrid': 24, 'mbd_maxscale': 500,
-                'kbotdav': 1, 'sigramplow': 0.00})
+    args = args.split()
+    for n, arg in enumerate(args):
+        if os.path.basename(arg) == command:
+            return int(args[n-1]) if n > 0 and args[n-1].isdigit() else None
 
-def set_downscaling():
-    "Set downscaling parameters"
+    return None
 
-    if d['dmode'] == 0:
-        d.update({'dmode_meth': 0, 'nud_p': 1, 'nud_q': 0, 'nud_t': 1,
-                'nud_uv': 1, 'mfix': 0, 'mfix_qg': 1, 'mfix_aero': 1,
-                'nbd': 0, 'mbd': d['mbd_base'], 'namip': 0, 'nud_aero': 0})
+def command_name(args):
+    "Short name of a command for profiles: the executable, skipping any MPI launcher"
 
-    elif d['dmode'] == 1:
-        d.update({'dmode_meth': 1, 'nud_p': 0, 'nud_q': 0, 'nud_t': 0,
-                'nud_uv': 0, 'mfix': 1, 'mfix_qg': 1, 'mfix_aero': 1,
-                'nbd': 0, 'mbd': 0, 'namip': 14, 'nud_aero': 0})
+    for arg in args:
+        if '/' in arg:
+            return os.path.basename(arg)
 
-    elif d['dmode'] == 2:
-        d.update({'dmode_meth': 0, 'nud_p': 1, 'nud_q': 1, 'nud_t': 1,
-                'nud_uv': 1, 'mfix': 0, 'mfix_qg': 0, 'mfix_aero': 0,
-                'nbd': 0, 'mbd': d['mbd_base'], 'namip': 0, 'nud_aero': 1})
+    return args[0]
 
-def set_cloud():
-    "Cloud microphysics settings"
+def run_stage(stage,*args):
+    "Run one stage of the month loop, recording its wall time, child CPU time and bytes written"
 
-    if d['cloud'] == 0:
-        d.update({'ncloud': 0})
+    start = usage_snapshot()
 
-    elif d['cloud'] == 1:
-        d.update({'ncloud': 2})
+    try:
+        stage(*args)
+    finally:
+        end = usage_snapshot()
+        profile['stages'].append(dict([('stage', stage.__name__)]+
+                                      [(key, end[key]-start[key]) for key in start]))
 
-    elif d['cloud'] == 2:
-        d.update({'ncloud': 3})
+def usage_snapshot():
+    """Wall time, CPU time of finished children and bytes written by this process and its
+    finished children (storage-layer counters; network filesystems may not report writes)"""
 
-def set_river():
-    "River physics settings"
+    times = os.times()
+    nbytes = resource.getrusage(resource.RUSAGE_CHILDREN).ru_oublock*512
 
-    if d['river'] == 0:
-        d.update({'nriver': 0})
+    # /proc/self/io includes reaped children and is more precise where available
+    if os.path.exists('/proc/self/io'):
+        for line in open('/proc/self/io'):
+            if line.startswith('write_bytes:'):
+                nbytes = int(line.split()[1])
 
-    elif d['river'] == 1:
-        d.update({'nriver': -1})
+    return {'wall': time.time(), 'cpu_children': times[2]+times[3], 'bytes_written': nbytes}
 
-def set_ocean():
-    "Ocean physics settings"
+def reset_profile():
+    "Start a new (empty) profile"
 
-    if d['mlo'] == 0:
-        #Interpolated SSTs
-        d.update({'nmlo': 0, 'mbd_mlo': 0, 'nud_sst': 0,
-                'nud_sss': 0, 'nud_ouv': 0, 'nud_sfh': 0,
-                'kbotmlo': -1000})
+    profile['stages'] = []
+    profile['commands'] = []
 
-    else:
-        #Dynanical Ocean
-        if d['river'] != 1:
-            raise ValueError, 'river=1 is a requirement for ocean mlo=1'
+def write_profile(month):
+    "Write the profile of a month to {hdir}/profile/profile.{month}.json and start a new one"
 
-        if d['dmode'] == 0 or d['dmode'] == 1:
-            # Downscaling mode - GCM or SST-only:
-            d.update({'nmlo': -3, 'mbd_mlo': 20, 'nud_sst': 1,
-                    'nud_sss': 0, 'nud_ouv': 0, 'nud_sfh': 0,
-                    'kbotmlo': -100})
+    profdir = dict2str('{hdir}/profile')
+    if not(os.path.isdir(profdir)):
+        os.mkdir(profdir)
 
-        elif d['dmode'] == 2:
-            # Downscaling CCAM:
-            d.update({'nmlo': -3, 'mbd_mlo': 20, 'nud_sst': 1,
-                    'nud_sss': 1, 'nud_ouv': 1, 'nud_sfh': 1,
-                    'kbotmlo': -1000})
+    record = {'month': month, 'name': d['name'], 'nproc': d['nproc'], 'ppnproc': d['ppnproc'],
+              'gridsize': d['gridsize'], 'mlev': d['mlev'], 'nseg': d.get('nseg',1),
+              'written': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'stages': profile['stages'], 'commands': profile['commands']}
 
-def set_atmos():
-    "Atmospheric physics settings"
-    if d['sib'] == 1:
-        d.update({'nsib': 7})
+    fname = os.path.join(profdir,'profile.'+month+'.json')
+    with open(fname+'.tmp','w') as ofile:
+        json.dump(record,ofile,indent=1,sort_keys=True)
+    os.rename(fname+'.tmp',fname)
 
-        if d['casa'] == 0:
-            d.update({'ccycle': 0, 'proglai': -1})
+    reset_profile()
 
-        elif d['casa'] == 1:
-            d.update({'ccycle': 3, 'proglai': 1})
+def profile_summary(hdir):
+    "Print the wall time of each stage and command, aggregated over all profiled months"
 
-    elif d['sib'] == 2:
-        d.update({'nsib': 5, 'ccycle': 0, 'proglai': -1})
+    fnames = sorted(glob.glob(os.path.join(hdir,'profile','profile.*.json')))
 
-        if d['casa'] == 1:
-            raise ValueError, "casa=1 requires sib=1"
+    if not fnames:
+        raise ValueError('No profiles found in '+os.path.join(hdir,'profile'))
 
-    d.update({ 'vegin': d['vegca'],
-        'vegprev': dict2str('veg{domain}.{imthlst_2digit}'),
-        'vegfile': dict2str('veg{domain}.{imth_2digit}'),
-        'vegnext': dict2str('veg{domain}.{imthnxt_2digit}'),
-        'vegnextb': dict2str('veg{domain}.{imthnxtb_2digit}') })
+    for kind, key in [('stages','stage'),('commands','command')]:
+        totals = {}
+        for fname in fnames:
+            for entry in json.load(open(fname))[kind]:
+                total = totals.setdefault(entry[key],{'count': 0, 'wall': 0., 'cpu_children': 0., 'bytes_written': 0})
+                total['count'] += 1
+                for field in ['wall','cpu_children','bytes_written']:
+                    total[field] += entry[field]
 
-    if d['bmix'] == 0:
-        d.update({'nvmix': 3, 'nlocal': 6})
+        walltotal = sum(total['wall'] for total in totals.values()) or 1.
 
-    elif d['bmix'] == 1:
-        d.update({'nvmix': 6, 'nlocal': 7})
+        print
+        print '{0:<28s} {1:>6s} {2:>12s} {3:>12s} {4:>7s} {5:>12s}'.format(key,'count','wall (s)','cpu (s)','wall %','MB written')
+        for name, total in sorted(totals.items(),key=lambda item: -item[1]['wall']):
+            print '{0:<28s} {1:6d} {2:12.1f} {3:12.1f} {4:7.1f} {5:12.1f}'.format(name,total['count'],total['wall'],
+                      total['cpu_children'],100.*total['wall']/walltotal,total['bytes_written']/1.e6)
 
-    d.update({'ngwd': -5, 'helim': 800., 'fc2': 1., 'sigbot_gwd': 0., 'alphaj': '0.000001'})
+    print
+    print str(len(fnames))+' profiles in '+os.path.join(hdir,'profile')
 
-    if d['conv'] == 2:
-        d.update({'ngwd': -20, 'helim': 1600.,'fc2': -0.5, 'sigbot_gwd': 1., 'alphaj': '0.025'})
+def unlimit_stack():
+    "Remove the stack size limit in child processes (equivalent of ulimit -s unlimited)"
 
-def set_surfc():
-    "Prepare surface files"
+    soft, hard = resource.getrlimit(resource.RLIMIT_STACK)
 
-    d.update({'tbave': 0, 'tblock': 0})
+    try:
+        resource.setrlimit(resource.RLIMIT_STACK,(resource.RLIM_INFINITY,hard))
+    except ValueError:
+        resource.setrlimit(resource.RLIMIT_STACK,(hard,hard))
 
-    if d['ncsurf'] in [1,2]:
-        d.update({'tbave': d['ktc_surf'] * 60 / d['dt'],
-                  'tblock': d['dtout'] / d['ktc_surf'] })
+def glob_files(pattern):
+    "Return the sorted list of file paths matching a pattern"
 
-def set_aeros():
-    "Prepare aerosol files"
+    return sorted(glob.glob(dict2str(pattern)))
 
-    if d['aero'] == 0:
-        # Aerosols turned off
-        d.update({'iaero': 0, 'sulffile' : 'none'})
+def move_files(pattern,dest):
+    "Move files matching a pattern to dest (a directory or a new file name)"
 
-    if d['aero'] == 1:
-        # Prognostic aerosols
-        d.update({'iaero': -2, 'sulffile': 'aero.nc'})
-
-        fpath_cmip =dict2str('{stdat}/{cmip}/{rcp}')
-
-        if d['rcp'] == "historic":
-            aero = {
-                    'so2_anth': get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_SO2_anthropogenic_{ddyear}*.nc'),
-                    'so2_ship': get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_SO2_ships_{ddyear}*.nc'),
-                    'so2_biom': get_fpath('{stdat}/{cmip}/{rcp}/IPCC_GriddedBiomassBurningEmissions_SO2_decadalmonthlymean{ddyear}*.nc'),
-                    'bc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_BC_anthropogenic_{ddyear}*.nc'),
-                    'bc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_BC_ships_{ddyear}*.nc'),
-                    'bc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_GriddedBiomassBurningEmissions_BC_decadalmonthlymean{ddyear}*.nc'),
-                    'oc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_OC_anthropogenic_{ddyear}*.nc'),
-                    'oc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_OC_ships_{ddyear}*.nc'),
-                    'oc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_GriddedBiomassBurningEmissions_OC_decadalmonthlymean{ddyear}*.nc')}
-
-        elif d['iyr'] >= 2010 :
-            aero = {
-                    'so2_anth': get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_SO2_anthropogenic_{ddyear}*.nc'),
-                    'so2_ship': get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_SO2_ships_{ddyear}*.nc'),
-                    'so2_biom': get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_SO2_biomassburning_{ddyear}*.nc'),
-                    'bc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_BC_anthropogenic_{ddyear}*.nc'),
-                    'bc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_BC_ships_{ddyear}*.nc'),
-                    'bc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_BC_biomassburning_{ddyear}*.nc'),
-                    'oc_anth':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_OC_anthropogenic_{ddyear}*.nc'),
-                    'oc_ship':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_OC_ships_{ddyear}*.nc'),
-                    'oc_biom':  get_fpath('{stdat}/{cmip}/{rcp}/IPCC_emissions_{rcp}_OC_biomassburning_{ddyear}*.nc')}
-        else:
-            aero = {
-                    'so2_anth': get_fpath('{stdat}/{cmip}/historic/IPCC_emissions_SO2_anthropogenic_{ddyear}*.nc'),
-                    'so2_ship': get_fpath('{stdat}/{cmip}/historic/IPCC_emissions_SO2_ships_{ddyear}*.nc'),
-                    'so2_biom': get_fpath('{stdat}/{cmip}/historic/IPCC_GriddedBiomassBurningEmissions_SO2_decadalmonthlymean{ddyear}*.nc'),
-                    'bc_anth':  get_fpath('{stdat}/{cmip}/historic/IPCC_emissions_BC_anthropogenic_{ddyear}*.nc'),
-                    'bc_ship':  get_fpath('{stdat}/{cmip}/historic/IPCC_emissions_BC_ships_{ddyear}*.nc'),
-                    'bc_biom':  get_fpath('{stdat}/{cmip}/historic/IPCC_GriddedBiomassBurningEmissions_BC_decadalmonthlymean{ddyear}*.nc'),
-                    'oc_anth':  get_fpath('{stdat}/{cmip}/historic/IPCC_emissions_OC_anthropogenic_{ddyear}*.nc'),
-                    'oc_ship':  get_fpath('{stdat}/{cmip}/historic/IPCC_emissions_OC_ships_{ddyear}*.nc'),
-                    'oc_biom':  get_fpath('{stdat}/{cmip}/historic/IPCC_GriddedBiomassBurningEmissions_OC_decadalmonthlymean{ddyear}*.nc')}
-
-        aero['volcano'] = dict2str('{stdat}/contineous_volc.nc')
-        aero['dmsfile'] = dict2str('{stdat}/dmsemiss.nc')
-        aero['dustfile'] = dict2str('{stdat}/ginoux.nc')     
-        
-        for fpath in aero.iterkeys():
-            check_file_exists(aero[fpath])
-
-        d.update(aero)
+    fnames = glob_files(pattern)
+    dest = dict2str(dest)
 
-def create_aeroemiss_file():
-    "Write arguments to 'aeroemiss' namelist file"
+    if not fnames:
+        raise ValueError('No files to move: '+dict2str(pattern))
 
-    if d['aero'] == 1:
-        write2file('aeroemiss.nml',aeroemiss_template(),mode='w+')
+    for fname in fnames:
+        target = dest
+        if os.path.isdir(dest):
+            target = os.path.join(dest,os.path.basename(fname))
+        if os.path.lexists(target) and not os.path.isdir(target):
+            os.remove(target)
+        shutil.move(fname,target)
 
-def create_sulffile_file():
-    "Create the aerosol forcing file"
+def link_files(pattern,dest):
+    "Create symbolic links in directory dest to files matching a pattern"
 
-    # Remove any existing sulffile:
-    run_cmdline('rm -rf {sulffile}')
+    fnames = glob_files(pattern)
+    dest = dict2str(dest)
 
-    # Create new sulffile:
-    run_cmdline('{aeroemiss} -o {sulffile} < aeroemiss.nml > aero.log || exit')
+    if not fnames:
+        raise ValueError('No files to link: '+dict2str(pattern))
 
-def create_input_file():
-    "Write arguments to the CCAM 'input' namelist file"
+    for fname in fnames:
+        target = os.path.join(dest,os.path.basename(fname))
+        if os.path.islink(target):
+            os.remove(target)
+        if not os.path.exists(target):
+            os.symlink(os.path.abspath(fname),target)
 
-    write2file('input',input_template_1(),mode='w+')
+def remove_files(*patterns):
+    "Remove files (or directories) matching one or more patterns"
 
-    if d['conv'] == 0:
-        write2file('input',input_template_2())
+    for pattern in patterns:
+        for fname in glob_files(pattern):
+            if os.path.isdir(fname) and not os.path.islink(fname):
+                shutil.rmtree(fname)
+            else:
+                os.remove(fname)
 
-    elif d['conv'] == 1:
-        write2file('input',input_template_3())
+def archive_files(tarname,pattern,remove=False):
+    """Stream files matching a pattern into a tar archive (gzip compressed if tarcomp=1).
+    Member checksums are verified by reading the archive back before it is renamed
+    into place; sources are only removed after a verified write"""
 
-    elif d['conv'] == 2:
-        write2file('input',input_template_4())
+    fnames = glob_files(pattern)
+    tarname = dict2str(tarname)
+    start = time.time()
 
-    write2file('input',input_template_5())
+    if not fnames:
+        raise ValueError('No files to archive: '+dict2str(pattern))
 
-def prepare_ccam_infiles():
-    "Prepare and check CCAM input data"
+    if d['tarcomp'] == 1:
+        tarname = tarname+'.gz'
 
-    if d['dmode'] == 0 or d['dmode'] == 2:
-        fpath = dict2str('{bcdir}/{mesonest}')
+    tmpname = tarname+'.tmp'
+    ofile = open(tmpname,'wb')
+    compressor = None
 
-        if d['bcdom'] == "ccam_eraint_":
-            check_file_exists(fpath)
-            run_cmdline('ln -s '+fpath+' .')
+    if d['tarcomp'] == 1 and d['tarthreads'] > 1 and find_executable('pigz'):
+        compressor = subprocess.Popen(['pigz','-p',str(d['tarthreads'])],stdin=subprocess.PIPE,stdout=ofile)
+        stream = compressor.stdin
+    elif d['tarcomp'] == 1:
+        stream = gzip.GzipFile(fileobj=ofile,mode='wb')
+    else:
+        stream = ofile
+
+    checksums = {}
+    tar = tarfile.open(fileobj=stream,mode='w|')
+    for fname in fnames:
+        print fname
+        with open(fname,'rb') as ifile:
+            reader = ChecksumReader(ifile)
+            tar.addfile(tar.gettarinfo(fname),reader)
+        checksums[fname] = reader.hexdigest()
+    tar.close()
+
+    stream.close()
+    if compressor is not None and compressor.wait() != 0:
+        raise ValueError('pigz failed while writing '+tarname)
+    ofile.close()
 
-        elif os.path.exists(fpath+'.000000'):
-            run_cmdline('ln -s '+fpath+'.?????? .')
+    verify_archive(tmpname,checksums)
+    os.rename(tmpname,tarname)
 
-        else:
-            check_file_exists(fpath+'.tar')
-            run_cmdline('tar xvf '+fpath+'.tar')
+    with open(tarname+'.md5','w') as md5file:
+        for fname in fnames:
+            md5file.write(checksums[fname]+'  '+fname+'\n')
 
-    if d['dmode'] == 1:
-        check_file_exists(dict2str('{sstinit}'))
-        run_cmdline('ln -s {sstinit} .')
+    log_cmd(['archive',tarname]+fnames,0,time.time()-start)
 
-    if not(os.path.exists(d['ifile'])) and not(os.path.exists(d['ifile']+'.000000')):
-        raise ValueError(dict2str('Cannot locate {ifile} or {ifile}.000000. ')+
-                         'If this is the start of a new run, please check that year.qm has been deleted')
+    if remove:
+        for fname in fnames:
+            os.remove(fname)
 
-    if d['dmode'] != 1:
-        if not(os.path.exists(d['mesonest'])) and not(os.path.exists(d['mesonest']+'.000000')):
-            raise ValueError(dict2str('Cannot locate {mesonest} or {mesonest}.000000'))
+def verify_archive(tarname,checksums):
+    "Read a tar archive back and compare its member checksums with those of the sources"
 
-    for file in ['topout{domain}', '{vegprev}', '{vegfile}', '{vegnext}', '{vegnextb}']:
-        check_file_exists(dict2str('{vegin}/'+file))
+    tar = tarfile.open(tarname,mode='r|*')
+    found = []
 
-    if d['nmlo'] != 0 and not(os.path.exists(dict2str('{vegin}/bath{domain}'))):
-        raise ValueError(dict2str('Cannot locate {vegin}/bath{domain}'))
+    for member in tar:
+        if not member.isfile():
+            continue
+        reader = ChecksumReader(tar.extractfile(member))
+        while reader.read(1024*1024):
+            pass
+        if checksums.get(member.name) != reader.hexdigest():
+            raise ValueError('Checksum mismatch for '+member.name+' in '+tarname)
+        found.append(member.name)
 
-    if d['aero'] != 0 and not(os.path.exists(d['sulffile'])):
-        raise ValueError('Cannot locate '+d['sulffile'])
+    tar.close()
 
-    if d['dmode'] == 1 and not(os.path.exists(dict2str('{sstdir}/{sstfile}'))):
-        raise ValueError(dict2str('Cannot locate {sstdir}/{sstfile}'))
+    if sorted(found) != sorted(checksums):
+        raise ValueError('Archive '+tarname+' does not contain all files')
 
-def check_correct_host():
-    "Check if host is CCAM"
+class ChecksumReader(object):
+    "File wrapper that computes the MD5 checksum of the data read through it"
 
-    if d['dmode'] in [0,2]:
-        for fname in [d['mesonest'], d['mesonest']+'.000000']:
-            if os.path.exists(fname):
-                ccam_host = (commands.getoutput('ncdump -c '+fname+' | grep -o version') == "version")
-                break
-        if ccam_host == True and d['dmode'] == 0:
-            raise ValueError('CCAM is the host model. Use dmode = 2')
-        elif ccam_host == False and d['dmode'] == 2:
-            raise ValueError('CCAM is not the host model. Use dmode = 0')
+    def __init__(self,ifile):
+        self.ifile = ifile
+        self.md5 = hashlib.md5()
 
-def check_correct_landuse():
-    "Check that land-use data matches what the user wants"
+    def read(self,size=-1):
+        data = self.ifile.read(size)
+        self.md5.update(data)
+        return data
 
-    fname = dict2str('{vegin}/{vegfile}')
+    def hexdigest(self):
+        return self.md5.hexdigest()
 
-    cable_data = (commands.getoutput('ncdump -c '+fname+' | grep -o cableversion') == "cableversion")
-    if d['sib'] == 2 and cable_data == True:
-        raise ValueError('MODIS surface selected with sib=2, but CABLE data is in the input file')
+def dict2str(str_template,context=None):
+    "Create a string that includes dictionary elements (of context, default d)"
 
-    modis_data = (commands.getoutput('ncdump -c '+fname+' | grep -o sibvegversion') == "sibvegversion")
-    if d['nsib'] == 1 and modis_data == True:
-        raise ValueError('CABLE surface selected with sib=1, but MODIS data is in the input file')
+    return render(str_template,context)
 
-def run_model():
-    "Execute the CCAM model"
+def write2file(fname,args_template,mode='a'):
+    "Write arguments to namelist file"
 
-    run_cmdline('mpirun -np {nproc} {model} > prnew.{kdates}.{name} 2> err.{iyr} || exit')
-    run_cmdline('rm {mesonest}.?????? {mesonest}')
+    with open(fname,mode) as ofile:
+        ofile.write(render(args_template))
 
-def post_process_output():
-    "Post-process the CCAM model output"
+    ofile.close()
 
-    if d['ncout'] == 1:
-        write2file('cc.nml',cc_template_1(),mode='w+')
-        run_cmdline('mpirun -np {nproc} {pcc2hist} > pcc2hist.log')
+def compile_template(template):
+    "Parse a template once and return the names of the keys it requires"
 
-    if d['ncout'] == 2:
-        write2file('cc.nml',cc_template_2(),mode='w+')
-        run_cmdline('mpirun -np {nproc} {pcc2hist} --cordex > pcc2hist.log')
+    if template not in compiled_templates:
+        keys = set()
+        for literal, field, spec, conversion in string.Formatter().parse(template):
+            if field is not None:
+                keys.add(re.split(r'[.\[]',field)[0])
+        compiled_templates[template] = keys
 
-    if d['ncout'] == 3:
-        if d['sib'] == 2:
-            for iday in xrange(1,d['ndays']+1):
-                d['cday'] = mon_2digit(iday)
-                d['iend'] = iday*1440
-                d['istart'] = (iday*1440)-1440
-                d['outctmfile'] = dict2str('ctm_{iyr}{imth_2digit}{cday}.nc',d)
-                write2file('cc.nml',cc_template_3(),mode='w+')
-                run_cmdline('mpirun -np {nproc} {pcc2hist} > pcc2hist_ctm.log')
+    return compiled_templates[template]
 
-            run_cmdline('tar cvf {hdir}/daily/ctm_{iyr}{imth_2digit}.tar ctm_{iyr}{imth}_2digit??.nc')
-            run_cmdline('rm ctm_{iyr}{imth_2digit}??.nc')
+def render(template,context=None):
+    "Fill a template from context (default d), reporting every missing key at once"
 
-        else:
-            raise ValueError(dict2str("Invalid land-use option for CTM sib={sib}. Please use sib=2 for CTM output",d))
+    if context is None:
+        context = d
 
-    # surface files
+    missing = compile_template(template) - set(context)
 
-    d['ktc_sec'] = d['ktc_surf']*60
+    if missing:
+        raise ValueError('Undefined keys '+', '.join(sorted(missing))+' in template: '+template.strip()[:80])
 
-    if d['ncsurf'] == 1:
-        write2file('cc.nml',cc_template_4(),mode='w+')
-        run_cmdline('mpirun -np {nproc} {pcc2hist} > surf.pcc2hist.log')
-        #run_cmdline('rm surf.{ofile}.??????')
+    return template.format(**context)
 
-    if d['ncsurf'] == 2 and d['nctar'] == 1:
-        write2file('cc.nml',cc_template_4(),mode='w+')
-        run_cmdline('tar cvf {hdir}/OUTPUT/surf.{ofile}.tar surf.{ofile}.??????')
-        #run_cmdline('rm surf.{ofile}.??????')
+def get_fpath(fpath):
+    """Get relevant file path(s); the most recently modified file matching the pattern,
+    as 'ls -1tr | tail -1' picks it: among files with the same mtime, the first by name.
+    Wildcards in the file name are answered from the directory index"""
 
-    # store output
-    if d['nctar'] == 0:
-        run_cmdline('mv {ofile}.?????? {hdir}/OUTPUT')
+    pattern = dict2str(fpath)
+    dirname, basename = os.path.split(os.path.abspath(pattern))
 
-    elif d['nctar'] == 1:
-        run_cmdline('tar cvf {hdir}/OUTPUT/{ofile}.tar {ofile}.??????')
-        run_cmdline('rm {ofile}.??????')
+    if glob.has_magic(dirname):
+        fnames = glob.glob(pattern)
+        return min(fnames,key=lambda fname: (-os.path.getmtime(fname),fname)) if fnames else pattern
 
-    # update counter for next simulation month and remove old files
-    d['imth'] = d['imth'] + 1
+    index = dir_index(dirname)
+    fnames = [fname for fname in fnmatch.filter(index.keys(),basename)
+              if basename.startswith('.') or not(fname.startswith('.'))]
 
-    if d['imth'] < 12:
-        run_cmdline('rm Rest{name}.{iyr}12.??????')
+    if not fnames:
+        return pattern
 
-    elif d['imth'] > 12:
-        run_cmdline('tar cvf {hdir}/RESTART/Rest{name}.{iyr}12.tar Rest{name}.{iyr}12*')
-        run_cmdline('rm Rest{name}.{iyr}0?.?????? Rest{name}.{iyr}10.?????? Rest{name}.{iyr}11.??????')
-        run_cmdline('rm prnew.{iyr}*')
-        run_cmdline('rm {name}*{iyr}??')
-        run_cmdline('rm {name}*{iyr}??.nc')
-        d['imth'] = 1
-        d['iyr'] = d['iyr'] + 1
+    return os.path.join(os.path.dirname(pattern),min(fnames,key=lambda fname: (-index[fname],fname)))
 
-def update_yearqm():
-    "Update the year.qm file"
+def dir_index(dirname):
+    """Names and modification times of the files in a directory. Listings are kept for
+    the whole run and in {hdir}/dirindex.json, and are rebuilt when the directory's
+    own mtime changes (files added, removed or renamed)"""
 
-    d['yyyymm'] = d['iyr'] * 100 + d['imth']
-    write2file(d['hdir']+'/year.qm',"{yyyymm}",mode='w+')
+    if not dir_indexes:
+        load_dir_indexes()
 
-def restart_flag():
-    "Create restart.qm containing flag for restart. This flag signifies that CCAM completed previous month"
+    mtime = os.path.getmtime(dirname) if os.path.isdir(dirname) else None
+    entry = dir_indexes.get(dirname)
 
-    write2file(d['hdir']+'/restart.qm',"True",mode='w+')
+    if entry is None or entry['mtime'] != mtime:
+        files = {}
+        if mtime is not None:
+            for fname in os.listdir(dirname):
+                try:
+                    files[fname] = os.path.getmtime(os.path.join(dirname,fname))
+                except OSError:
+                    pass
+        entry = {'mtime': mtime, 'files': files}
+        dir_indexes[dirname] = entry
+        save_dir_indexes()
 
+    return entry['files']
 
-def run_cmdline(arg):
-    "Run a command line argument from within python"
+def load_dir_indexes():
+    "Read the directory index saved by previous jobs of this run"
 
-    os.system(dict2str(arg))
+    fname = dict2str('{hdir}/dirindex.json')
 
-def dict2str(str_template):
-    "Create a string that includes dictionary elements"
+    if os.path.exists(fname):
+        try:
+            dir_indexes.update(json.load(open(fname)))
+        except ValueError:
+            print "WARNING: ignoring unreadable "+fname
 
-    return str_template.format(**d)
+def save_dir_indexes():
+    "Save the directory index to {hdir}/dirindex.json"
 
-def write2file(fname,args_template,mode='a'):
-    "Write arguments to namelist file"
+    fname = dict2str('{hdir}/dirindex.json')
+    tmpname = fname+'.'+str(os.getpid())
 
-    with open(fname,mode) as ofile:
-        ofile.write(args_template.format(**d))
+    with open(tmpname,'w') as ofile:
+        json.dump(dir_indexes,ofile)
+    os.rename(tmpname,fname)
 
-    ofile.close()
+def read_nc_header(fname):
+    """Read the global attributes and dimension sizes of a NetCDF file.
+    Headers are cached per path and modification time for the whole run"""
 
-def get_fpath(fpath):
-    "Get relevant file path(s)"
-    return commands.getoutput(dict2str('ls -1tr '+fpath+' | tail -1'))
+    key = (os.path.realpath(fname), os.path.getmtime(fname))
+
+    if key not in nc_headers:
+        fread = Dataset(fname,'r')
+        nc_headers[key] = {'attrs': dict((att, fread.getncattr(att)) for att in fread.ncattrs()),
+                           'dims': dict((name, len(dim)) for name, dim in fread.dimensions.iteritems())}
+        fread.close()
+
+    return nc_headers[key]
 
 def check_file_exists(path):
     "Check that the specified file path exists"
@@ -707,6 +3355,14 @@ def check_file_exists(path):
     if not (os.path.exists(path)):
         raise ValueError('File not found: '+path)
 
+def month_days(iyr,imth):
+    "Number of days in a month of the simulation calendar"
+
+    if (imth == 2) and (d['leap'] == 0):
+        return 28 #leap year turned off
+
+    return monthrange(iyr,imth)[1]
+
 def mon_2digit(imth):
     "Create 2-digit numerical string for given month"
 
@@ -858,8 +3514,8 @@ def input_template_1():
      so4tfile=   '{sulffile}'
      oxidantfile='{stdat}/oxidants.nc'
      ofile=      '{ofile}'
-     restfile=   'Rest{name}.{iyr}{imth_2digit}'
-     sstfile=    '{sstdir}/{sstfile}'
+     restfile=   '{restfile}'
+     sstfile=    '{sstpath}'
      casafile=   '{vegin}/casa{domain}'
      phenfile=   '{stdat}/modis_phenology_csiro.txt'"""
      
@@ -961,9 +3617,9 @@ def cc_template_1():
     return """\
     &input
      ifile = "{ofile}"
-     ofile = "{hdir}/daily/{ofile}.nc"
+     ofile = "{hdir}/daily/{histfile}.nc"
      hres  = {res}
-     kta={ktc}   ktb=999999  ktc={ktc}
+     kta={kta}   ktb={ktb}  ktc={ktc}
      minlat = {minlat}, maxlat = {maxlat}, minlon = {minlon},  maxlon = {maxlon}
      use_plevs = T
      plevs = {plevs}
@@ -979,9 +3635,9 @@ def cc_template_2():
     return """\
     &input
      ifile = "{ofile}"
-     ofile = "{hdir}/daily/{ofile}.nc"
+     ofile = "{hdir}/daily/{histfile}.nc"
      hres  = {res}
-     kta={ktc}   ktb=999999  ktc={ktc}
+     kta={kta}   ktb={ktb}  ktc={ktc}
      minlat = {minlat}, maxlat = {maxlat}, minlon = {minlon},  maxlon = {maxlon}
      use_plevs = T
      plevs = {plevs}
@@ -996,8 +3652,8 @@ def cc_template_3():
 
     return """\
     &input
-     ifile = "{ofile}"
-     ofile = "{outctmfile}"
+     ifile = "../{ofile}"
+     ofile = "../{outctmfile}"
      hres  = {res}
      kta={istart} ktb={iend} ktc=60
      minlat = {minlat}, maxlat = {maxlat}
@@ -1019,9 +3675,9 @@ def cc_template_4():
     return """\
     &input
      ifile = "surf.{ofile}"
-     ofile = "{hdir}/daily/surf.{ofile}.nc"
+     ofile = "{hdir}/daily/surf.{histfile}.nc"
      hres  = {res}
-     kta={ktc_sec}   ktb=2999999  ktc={ktc_sec}
+     kta={kta_sec}   ktb={ktb_sec}  ktc={ktc_sec}
      minlat = {minlat}, maxlat = {maxlat}, minlon = {minlon},  maxlon = {maxlon}
     &end
     &histnl
@@ -1030,6 +3686,23 @@ def cc_template_4():
      hfreq = 1
     &end"""
 
+def cc_template_5():
+    "Template for the 'cc.nml' namelist file of the surface winds (surfpp=python)"
+
+    return """\
+    &input
+     ifile = "surf.{ofile}"
+     ofile = "{hdir}/daily/surfwind.{histfile}.nc"
+     hres  = {res}
+     kta={kta_sec}   ktb={ktb_sec}  ktc={ktc_sec}
+     minlat = {minlat}, maxlat = {maxlat}, minlon = {minlon},  maxlon = {maxlon}
+    &end
+    &histnl
+     htype="inst"
+     hnames= "uas","vas","d10"
+     hfreq = 1
+    &end"""
+
 if __name__ == '__main__':
 
     extra_info="""
@@ -1059,6 +3732,7 @@ if __name__ == '__main__':
     parser.add_argument("--ime", type=int, choices=[1,2,3,4,5,6,7,8,9,10,11,12], help=" end month [MM]")
     parser.add_argument("--leap", type=int, choices=[0,1], help=" Use leap days (0=off, 1=on)")
     parser.add_argument("--ncountmax", type=int, help=" Number of months before resubmit")
+    parser.add_argument("--nmonths", type=int, default=1, help=" Number of months integrated per model launch (requires dmode=1 and aero=0 if >1)")
 
     parser.add_argument("--ktc", type=int, help=" standard output period (mins)")
     parser.add_argument("--minlat", type=float, help=" output min latitude (degrees)")
@@ -1081,9 +3755,26 @@ if __name__ == '__main__':
 
     parser.add_argument("--ncout", type=int, choices=[0,1,2,3], help=" standard output format (0=none, 1=CCAM, 2=CORDEX, 3=CTM)")
     parser.add_argument("--nctar", type=int, choices=[0,1], help=" TAR output files in OUTPUT directory (0=off, 1=on)")
+    parser.add_argument("--tarcomp", type=int, choices=[0,1], default=0, help=" Compress TAR output files (0=off, 1=gzip)")
+    parser.add_argument("--tarthreads", type=int, default=1, help=" Threads for TAR compression (>1 uses pigz if available)")
     parser.add_argument("--ncsurf", type=int, choices=[0,1,2], help=" High-freq output (0=none, 1=lat/lon, 2=raw)")
+    parser.add_argument("--surfpp", type=str, choices=['pcc2hist','python'], default='pcc2hist', help=" post-processor for ncsurf=1 output (pcc2hist or python interpolation with cached weights)")
     parser.add_argument("--ktc_surf", type=int, help=" High-freq file output period (mins)")
 
+    parser.add_argument("--mpi", type=str, default="mpirun -np", help=" MPI launcher for the model, e.g. 'srun --exclusive -n' when sharing an allocation")
+    parser.add_argument("--pipeline", type=int, choices=[0,1], default=0, help=" Post-process month N while month N+1 runs (0=off, 1=on)")
+    parser.add_argument("--resubmit", type=str, default="none", help=" job script to submit for the next segment of the run (none=off)")
+    parser.add_argument("--sbatch", type=str, default="sbatch", help=" batch submission command")
+    parser.add_argument("--walltime", type=str, default="none", help=" walltime of the job ([D-]HH:MM:SS) for sizing ncountmax (none=time limit of the Slurm job, else use ncountmax)")
+    parser.add_argument("--wallfrac", type=float, default=0.9, help=" fraction of the remaining walltime that may be used for months")
+    parser.add_argument("--plan", type=int, choices=[0,1], default=0, help=" Check the inputs of all months before the first model launch (0=each month at its launch, 1=all months; every host file must already exist)")
+    parser.add_argument("--autotune", type=int, choices=[0,1], default=0, help=" Choose nproc and ppnproc from previous timings (0=off, 1=on)")
+    parser.add_argument("--maxproc", type=int, default=0, help=" maximum processors available to the model for autotune (0=nproc)")
+    parser.add_argument("--autotune_eff", type=float, default=0.7, help=" minimum parallel efficiency accepted by autotune")
+    parser.add_argument("--ppnproc", type=int, default=0, help=" number of processors for pcc2hist (0=nproc, or nproc/4 with pipeline=1)")
+    parser.add_argument("--ctmnproc", type=int, default=0, help=" number of processors per daily CTM pcc2hist job (0=ppnproc/4 with ppmpi='srun --exclusive -n', else ppnproc); concurrent jobs need srun --exclusive")
+    parser.add_argument("--ppmpi", type=str, default="mpirun -np", help=" MPI launcher for pcc2hist, e.g. 'srun --exclusive -n' for a separate job step")
+
     parser.add_argument("--bcdom", type=str, help=" host file prefix for dmode=0 or dmode=2")
 
     parser.add_argument("--sstfile", type=str, help=" sst file for dmode=1")
@@ -1100,6 +3791,18 @@ if __name__ == '__main__':
     parser.add_argument("--sstdir", type=str, help=" SST data (for dmode=1)")
     parser.add_argument("--stdat", type=str, help=" eigen and radiation datafiles")
     parser.add_argument("--vegca", type=str, help=" topographic datasets")
+    parser.add_argument("--stagedir", type=str, default="none", help=" fast scratch directory for prefetching next month's inputs (none=off)")
+    parser.add_argument("--stats", type=int, choices=[0,1], default=0, help=" Write daily and monthly statistics of the output (0=off, 1=on)")
+    parser.add_argument("--stats_hist", type=str, default="none", help=" histograms in the statistics, as name:lo:hi:nbins,... (none=off)")
+    parser.add_argument("--rechunk", type=int, choices=[0,1], default=0, help=" Write time series files chunked for point access (0=off, 1=on)")
+    parser.add_argument("--rechunk_shape", type=str, default="0,16,16", help=" time,lat,lon chunk sizes of the time series files (time 0 = whole month)")
+    parser.add_argument("--rechunk_workers", type=int, default=4, help=" processes on this node for rechunking variables in parallel")
+    parser.add_argument("--rechunk_mem", type=int, default=256, help=" data held in memory by each rechunking process (MB)")
+    parser.add_argument("--deflate", type=int, choices=range(10), default=4, help=" deflate level of the time series files (0=off)")
+    parser.add_argument("--shuffle", type=int, choices=[0,1], default=1, help=" byte shuffle filter for the time series files (0=off, 1=on)")
+    parser.add_argument("--weightdir", type=str, default="none", help=" shared store of interpolation weights (none={vegca}/weights)")
+    parser.add_argument("--surfcache", type=str, default="none", help=" shared cache directory for generated surface datasets (none=off)")
+    parser.add_argument("--surfcache_size", type=float, default=100., help=" maximum size of the surface dataset cache (GB)")
     parser.add_argument("--aeroemiss", type=str, help=" path of aeroemiss executable")
     parser.add_argument("--model", type=str, help=" path of globpea executable")
     parser.add_argument("--pcc2hist", type=str, help=" path of pcc2hist executable")
@@ -1108,6 +3811,10 @@ if __name__ == '__main__':
     parser.add_argument("--ocnbath", type=str, help=" path of ocnbath executable")
     parser.add_argument("--casafield", type=str, help=" path of casafield executable")
 
+    parser.add_argument("--summary", type=str, default="none", help=" print the stage/command timing summary of the run in this hdir and exit")
+    parser.add_argument("--ensemble", type=str, default="none", help=" CSV table of ensemble members; columns override input arguments (none=single run)")
+    parser.add_argument("--ensnproc", type=int, default=0, help=" total processors shared by concurrent ensemble members")
+
     args = parser.parse_args()
 
     main(args)
@@ -58,7 +58,9 @@ ims=01                                       ;# start month
 iye=2005                                     ;# end year
 ime=01                                       ;# end month
 leap=1                                       ;# Use leap days (0=off, 1=on)
-ncountmax=12                                 ;# Number of months before resubmit
+ncountmax=12                                 ;# Number of months before resubmit (sized from walltime once months are timed)
+walltime=none                                ;# Job walltime ([D-]HH:MM:SS; none=read from the Slurm job with squeue)
+nmonths=1                                    ;# Number of months per model launch (>1 requires dmode=1 and aero=0)
 
 ktc=360                                                  ;# standard output period (mins)
 minlat=$(bc -l <<< "( $midlat - $gridres * 1./112. * $gridsize / 2.)") ;# output min latitude (degrees)
@@ -82,8 +84,23 @@ casa=0                                       ;# CASA-CNP carbon cycle with progn
 
 ncout=1                                      ;# standard output format (0=none, 1=CCAM, 2=CORDEX, 3=CTM)
 nctar=1                                      ;# TAR output files in OUTPUT directory (0=off, 1=on)
+tarcomp=0                                    ;# Compress TAR output files (0=off, 1=gzip)
+tarthreads=1                                 ;# Threads for TAR compression (>1 uses pigz if available)
 ncsurf=0                                     ;# High-freq output (0=none, 1=lat/lon, 2=raw)
 ktc_surf=5                                   ;# High-freq file output period (mins)
+surfpp=pcc2hist                              ;# ncsurf=1 post-processor (pcc2hist, or python with cached interpolation weights)
+stats=0                                      ;# Daily and monthly statistics of the output (0=off, 1=on)
+stats_hist=none                              ;# Histograms in the statistics, e.g. tscrn:230:330:100,rnd:0:100:50 (none=off)
+rechunk=0                                    ;# Time series files chunked for point access (0=off, 1=on)
+rechunk_shape=0,16,16                        ;# time,lat,lon chunk sizes of the time series files (time 0 = whole month)
+rechunk_workers=4                            ;# processes for rechunking variables in parallel (on the batch node)
+rechunk_mem=256                              ;# data held in memory by each rechunking process (MB)
+
+pipeline=0                                   ;# Post-process month N while month N+1 runs (0=off, 1=on)
+ppnproc=0                                    ;# number of processors for pcc2hist (0=nproc, or nproc/4 with pipeline=1)
+ctmnproc=0                                   ;# number of processors per daily CTM pcc2hist job (0=ppnproc/4 with ppmpi="srun --exclusive -n", else ppnproc)
+ppmpi="srun --exclusive -n"                  ;# launcher for pcc2hist jobs (separate job steps; concurrent CTM days need --exclusive)
+autotune=0                                   ;# Choose nproc and ppnproc from previous timings (0=off, 1=on)
 
 bcdom=ccam_eraint_                            ;# host file prefix for dmode=0 or dmode=2
 
@@ -99,6 +116,8 @@ bcdir=$insdir/erain            ;# host atmospheric data (for dmode=0 or dmode=2)
 sstdir=$insdir/gcmsst         ;# SST data (for dmode=1)
 stdat=$insdir/ccamdata        ;# eigen and radiation datafiles
 vegca=$hdir/vegdata         ;# topographic datasets
+surfcache=none                ;# shared cache of generated topographic datasets (none=off)
+stagedir=none                 ;# fast scratch for prefetching next month's inputs, e.g. $TMPDIR (none=off)
 
 sstfile=ACCESS1-0_RCP45_bcvc_osc_ots_santop96_18_0.0_0.0_1.0.nc ;# sst file for dmode=1
 sstinit=$bcdir/$bcdom$iys$ims.nc          ;# initial conditions file for dmode=1
@@ -120,17 +139,14 @@ casafield=$insdir/src/bin/casafield
 ###############################################################
 
 python $excdir/run_ccam.py --name $name --nproc $nproc --midlon " $midlon" --midlat " $midlat" --gridres $gridres \
-                   --gridsize $gridsize --mlev $mlev --iys $iys --ims $ims --iye $iye --ime $ime --leap $leap \
+                   --gridsize $gridsize --mlev $mlev --iys $iys --ims $ims --iye $iye --ime $ime --leap $leap --nmonths $nmonths \
                    --ncountmax $ncountmax --ktc $ktc --minlat " $minlat" --maxlat " $maxlat" --minlon $minlon \
                    --maxlon $maxlon --reqres " $reqres" --plevs ${plevs// /} --dmode $dmode --nstrength $nstrength \
                    --sib $sib --aero $aero --conv $conv --cloud $cloud --bmix $bmix --river $river --mlo $mlo \
-                   --casa $casa --ncout $ncout --nctar $nctar --ncsurf $ncsurf --ktc_surf $ktc_surf --bcdom $bcdom \
+                   --casa $casa --ncout $ncout --nctar $nctar --tarcomp $tarcomp --tarthreads $tarthreads --ncsurf $ncsurf --ktc_surf $ktc_surf --surfpp $surfpp --stats $stats --stats_hist $stats_hist --rechunk $rechunk --rechunk_shape $rechunk_shape --rechunk_workers $rechunk_workers --rechunk_mem $rechunk_mem --bcdom $bcdom \
+                   --pipeline $pipeline --ppnproc $ppnproc --ctmnproc $ctmnproc --ppmpi "$ppmpi" --autotune $autotune --maxproc $nproc \
                    --sstfile $sstfile --sstinit $sstinit --cmip $cmip --rcp $rcp --insdir $insdir --hdir $hdir \
-                   --bcdir $bcdir --sstdir $sstdir --stdat $stdat --vegca $vegca \
+                   --bcdir $bcdir --sstdir $sstdir --stdat $stdat --vegca $vegca --surfcache $surfcache --stagedir $stagedir \
                    --aeroemiss $aeroemiss --model $model --pcc2hist $pcc2hist --terread $terread --igbpveg $igbpveg \
-                   --ocnbath $ocnbath --casafield $casafield
-
-if [ "`cat $hdir/year.qw`" != "Complete" ] && [ "`cat $hdir/restart.qw`" == "True" ]; then
-  echo 'Restarting script'
-  sbatch $excdir/run_ccam.sh
-fi
+                   --ocnbath $ocnbath --casafield $casafield \
+                   --resubmit $excdir/run_ccam.sh --walltime $walltime